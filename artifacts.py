@@ -0,0 +1,62 @@
+'''Compact result artifacts written by the compute step and read by the
+rendering scripts.
+
+An artifact is a .npz file of arrays with a JSON file of metadata next to it
+(<name>.npz and <name>.json). Nested dicts of arrays are stored with their
+keys joined by dots and restored on loading.
+'''
+
+import json
+import os
+import numpy as np
+
+artifact_dir = 'artifacts'
+
+
+def flatten(arrays, prefix=''):
+    '''Flattens a nested dict of arrays into {'a.b.c': array}'''
+    flat = {}
+    for key, value in arrays.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = np.asarray(value)
+    return flat
+
+
+def unflatten(flat):
+    '''Inverse of flatten'''
+    arrays = {}
+    for key, value in flat.items():
+        d = arrays
+        parts = key.split('.')
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+        d[parts[-1]] = value
+    return arrays
+
+
+def artifact_path(name, directory=artifact_dir):
+    '''Extension-less path of the artifact called name'''
+    return directory + '/' + name
+
+
+def save_artifact(path, arrays, meta=None):
+    '''Writes a nested dict of arrays to <path>.npz and meta to <path>.json'''
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    np.savez(path + '.npz', **flatten(arrays))
+    with open(path + '.json', 'w') as f:
+        json.dump(meta or {}, f, indent=1)
+
+
+def load_artifact(path):
+    '''Returns the nested dict of arrays and the metadata of an artifact'''
+    with np.load(path + '.npz') as f:
+        arrays = unflatten(dict(f))
+    meta = {}
+    if os.path.exists(path + '.json'):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+    return arrays, meta
@@ -0,0 +1,187 @@
+'''Timing and peak-memory benchmarks of the hot paths of the pipeline on
+fixture datasets (see fixtures.py).
+
+Each benchmark loads its inputs once, runs once untraced to warm up
+(imports, caches and other one-time allocations), once under tracemalloc for
+the peak memory allocated by the run (NumPy reports its buffers to
+tracemalloc) and then repeat times under time.perf_counter. Results are saved as JSON
+together with the fixture size, the NumPy version and the git revision,
+and can be compared with an earlier results file to spot regressions:
+
+    python benchmarks.py [--sites 10] [--realizations 1000] [--hist-years 81] [--csv]
+                         [--repeat 3] [--only name ...] [--compare benchmark-results/<old>.json]
+
+With --csv the fixture also has CSV copies, and the ingest benchmarks are
+repeated on a copy of the CSV files alone, which load_flows() has to parse.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+
+from convergence import convergence_curves, internal_variability_stats, load_cube
+from correlation import correlation_stats
+from extremes import site_extremes
+from fdc import fdc_envelopes, streaming_fdc_envelopes
+from fixtures import read_fixture, write_fixtures
+from flows_by_site import ingest_historical, ingest_synthetic
+from flowstore import load_flows
+from moments import bootstrap_moments, load_weekly, site_moments, weekly_pvalues
+from stress import synthetic_filename
+
+results_dir = 'benchmark-results'
+fixture_dir = 'fixture-data'
+
+
+def csv_only(root, datadir, filenames):
+    '''A copy of some CSV files of a fixture data directory without their binary copies'''
+    copy = root + '/csv-only/' + datadir
+    if not os.path.exists(copy):
+        os.makedirs(copy)
+        for filename in filenames:
+            shutil.copy(root + '/' + datadir + '/' + filename, copy)
+    return copy
+
+
+def benchmarks(root, sites, csv=False):
+    '''(name, setup, run) of every benchmark on the fixture under root; run
+    is called with the result of setup. With csv, the ingest benchmarks are
+    also run on CSV files alone.'''
+    hist_datadir = root + '/historical-data'
+    syn_datadir = root + '/synthetic-data-stat'
+    hist_path = hist_datadir + '/Qdaily-hist.csv'
+    syn_path = syn_datadir + '/Qdaily-syn-stat.csv'
+    site = sites[0]
+    weekly = lambda: load_weekly(site, hist_datadir, syn_datadir, 60)
+    cube = lambda: np.array(load_cube(site, syn_datadir, 60))
+    benches = [
+        ('ingest-historical', lambda: None, lambda _: ingest_historical(hist_datadir, sites)),
+        ('ingest-synthetic', lambda: None, lambda _: ingest_synthetic(syn_datadir, 1, sites)),
+        ('fdc-envelopes', lambda: np.array(load_flows(syn_path)), fdc_envelopes),
+        ('fdc-streaming', lambda: syn_path, streaming_fdc_envelopes),
+        ('weekly-pvalues', lambda: [np.array(X) for X in weekly()],
+         lambda d: weekly_pvalues(d[0], np.reshape(d[1], (-1, 52)))),
+        ('bootstrap-moments', lambda: np.array(weekly()[0]), lambda H: bootstrap_moments(H, 1000, seed=0)),
+        ('site-moments', lambda: [np.array(X) for X in weekly()], lambda d: site_moments(d[0], d[1], seed=0)),
+        ('convergence-curves', cube, convergence_curves),
+        ('internal-variability', cube, internal_variability_stats),
+        ('correlation', lambda: (load_flows(hist_path), np.array(load_flows(syn_path))),
+         lambda d: correlation_stats(*d)),
+        ('extremes', lambda: [np.array(X) for X in weekly()], lambda d: site_extremes(*d)),
+    ]
+    if csv:
+        benches[2:2] = [
+            ('ingest-historical-csv', lambda: csv_only(root, 'historical-data', [site + '.csv' for site in sites]),
+             lambda datadir: ingest_historical(datadir, sites)),
+            ('ingest-synthetic-csv',
+             lambda: csv_only(root, 'synthetic-data-stat',
+                              [os.path.basename(synthetic_filename(syn_datadir, site, 1)) for site in sites]),
+             lambda datadir: ingest_synthetic(datadir, 1, sites)),
+        ]
+    return benches
+
+
+def measure(setup, run, repeat=3):
+    '''Best and median wall time of run(setup()) over repeat runs, and the
+    peak memory allocated during one run'''
+    args = setup()
+    # keep one-time allocations out of the traced peak
+    run(args)
+    tracemalloc.start()
+    run(args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        run(args)
+        times.append(time.perf_counter() - t0)
+    return {'best_s': min(times), 'median_s': float(np.median(times)), 'peak_mb': peak / 2**20}
+
+
+def git_revision():
+    '''The current git revision, or None outside a git checkout'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(nsites=10, num_realizations=1000, nhist_years=81, repeat=3, only=None, root=None, csv=False):
+    '''Runs the benchmarks on a fixture of the given size, generating it first
+    if needed, and returns the results'''
+    root = root or '%s/bench-%d-%d-%d%s' % (fixture_dir, nsites, num_realizations, nhist_years, '-csv' if csv else '')
+    fixture = read_fixture(root)
+    if fixture is None or (fixture['nsites'], fixture['num_realizations'], fixture['nhist_years'],
+                           fixture.get('csv', False)) != (nsites, num_realizations, nhist_years, csv):
+        if os.path.exists(root + '/csv-only'):
+            shutil.rmtree(root + '/csv-only')
+        fixture = write_fixtures(root, nsites, num_realizations, nhist_years, csv=csv)
+
+    results = {'revision': git_revision(), 'numpy': np.__version__, 'python': platform.python_version(),
+               'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeat': repeat,
+               'fixture': dict((key, fixture[key]) for key in ('nsites', 'num_realizations', 'nhist_years', 'csv')),
+               'benchmarks': {}}
+    for name, setup, run in benchmarks(root, fixture['sites'], csv):
+        if only and name not in only:
+            continue
+        results['benchmarks'][name] = measure(setup, run, repeat)
+        r = results['benchmarks'][name]
+        print('%-22s %9.4f s %9.1f MB' % (name, r['best_s'], r['peak_mb']))
+    return results
+
+
+def save_results(results, path=None):
+    '''Writes results to path, by default benchmark-results/<revision>-<fixture size>.json'''
+    if path is None:
+        f = results['fixture']
+        path = '%s/%s-%d-%d-%d%s.json' % (results_dir, results['revision'] or time.strftime('%Y%m%d-%H%M%S'),
+                                           f['nsites'], f['num_realizations'], f['nhist_years'],
+                                           '-csv' if f.get('csv') else '')
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return path
+
+
+def compare(baseline, results, tolerance=1.2):
+    '''Lines comparing two results; benchmarks slower or larger than
+    tolerance times the baseline are marked as regressions'''
+    lines = []
+    for name, r in results['benchmarks'].items():
+        b = baseline['benchmarks'].get(name)
+        if b is None:
+            continue
+        time_ratio = r['best_s'] / b['best_s']
+        mem_ratio = r['peak_mb'] / b['peak_mb'] if b['peak_mb'] > 0 else 1.0
+        flag = 'REGRESSION' if time_ratio > tolerance or mem_ratio > tolerance else ''
+        lines.append('%-22s time x%5.2f  memory x%5.2f  %s' % (name, time_ratio, mem_ratio, flag))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline on fixture datasets.')
+    parser.add_argument('--sites', type=int, default=10)
+    parser.add_argument('--realizations', type=int, default=1000)
+    parser.add_argument('--hist-years', type=int, default=81)
+    parser.add_argument('--csv', action='store_true', help='also benchmark ingesting CSV files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='results file; benchmark-results/<revision>-<size>.json by default')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sites, args.realizations, args.hist_years, args.repeat, args.only, csv=args.csv)
+    print('saved ' + save_results(results, args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), results)))
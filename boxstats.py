@@ -0,0 +1,203 @@
+'''Precomputed boxplot statistics.
+
+box_stats() computes, for every column of a sample at once, the quartiles,
+mean and whisker ends that matplotlib's boxplot() would compute (whiskers at
+the furthest data within whis*IQR of the box). bxp_stats() turns them into
+the list of dicts expected by Axes.bxp, so that figures can be drawn from
+stored statistics without the raw data.
+
+QuantileSketch computes the same statistics from data seen in chunks, in
+memory independent of the number of observations. Each column keeps counts
+in logarithmically spaced buckets (the DDSketch layout), so every quantile
+is within relative_accuracy of the exact one, and sketches built on
+separate chunks, shards or processes are merged by adding their counts.
+The mean, minimum and maximum are kept exactly. The whisker limits are
+computed from the approximate quartiles, so the whisker ends only meet a
+looser bound, given by QuantileSketch.whisker_error().
+'''
+
+import numpy as np
+
+
+def box_stats(X, whis=1.5, axis=0):
+    '''Boxplot statistics of each column of X (or along axis).
+
+    Returns a dict of arrays 'q1', 'med', 'q3', 'mean', 'whislo' and 'whishi'.'''
+    X = np.moveaxis(np.asarray(X), axis, 0)
+    q1, med, q3 = np.percentile(X, [25, 50, 75], axis=0)
+    iqr = q3 - q1
+    lo = q1 - whis*iqr
+    hi = q3 + whis*iqr
+    whislo = np.min(np.where(X >= lo, X, np.inf), axis=0)
+    whishi = np.max(np.where(X <= hi, X, -np.inf), axis=0)
+    return {'q1': q1, 'med': med, 'q3': q3, 'mean': X.mean(axis=0),
+            'whislo': np.minimum(whislo, q1), 'whishi': np.maximum(whishi, q3)}
+
+
+def bxp_stats(stats):
+    '''Converts box_stats() arrays into the list of dicts taken by Axes.bxp'''
+    keys = ('q1', 'med', 'q3', 'mean', 'whislo', 'whishi')
+    n = len(np.atleast_1d(stats['med']))
+    return [dict([(key, np.atleast_1d(stats[key])[i]) for key in keys] + [('fliers', [])])
+            for i in range(n)]
+
+
+
+class QuantileSketch(object):
+    '''Mergeable per-column quantile summary of a stream of nobs x ncols chunks
+
+    @param ncols The number of columns (e.g. 52 weeks)
+    @param relative_accuracy The relative error bound of the quantiles
+    '''
+
+    def __init__(self, ncols, relative_accuracy=0.005):
+        self.ncols = ncols
+        self.relative_accuracy = relative_accuracy
+        self.log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.count = np.zeros(ncols, dtype=np.int64)
+        self.sum = np.zeros(ncols)
+        self.min = np.full(ncols, np.inf)
+        self.max = np.full(ncols, -np.inf)
+        self.zeros = np.zeros(ncols, dtype=np.int64)
+        # bucket counts of the positive and (negated) negative values, from key offset upwards
+        self.stores = {1: (0, np.zeros((ncols, 0), dtype=np.int64)),
+                       -1: (0, np.zeros((ncols, 0), dtype=np.int64))}
+
+    def _key(self, x):
+        return np.ceil(np.log(x) / self.log_gamma).astype(np.int64)
+
+    def _value(self, key):
+        '''Value representing a bucket, within relative_accuracy of all its values'''
+        gamma = np.exp(self.log_gamma)
+        return 2*np.exp(key*self.log_gamma) / (gamma + 1)
+
+    def _bounds(self, values):
+        '''Lower and upper boundaries of the buckets represented by values'''
+        gamma = np.exp(self.log_gamma)
+        upper = np.abs(values)*(gamma + 1)/2
+        lower = upper / gamma
+        return np.where(values < 0, -upper, lower), np.where(values < 0, -lower, upper)
+
+    def _add_counts(self, sign, offset, counts):
+        '''Adds a ncols x nkeys block of bucket counts starting at key offset'''
+        old_offset, old = self.stores[sign]
+        if old.shape[1] == 0:
+            self.stores[sign] = (offset, counts.copy())
+            return
+        lo = min(offset, old_offset)
+        hi = max(offset + counts.shape[1], old_offset + old.shape[1])
+        merged = np.zeros((self.ncols, hi - lo), dtype=np.int64)
+        merged[:, old_offset - lo:old_offset - lo + old.shape[1]] += old
+        merged[:, offset - lo:offset - lo + counts.shape[1]] += counts
+        self.stores[sign] = (lo, merged)
+
+    def update(self, X):
+        '''Adds a chunk of observations X (nobs x ncols)'''
+        X = np.asarray(X, dtype=float).reshape(-1, self.ncols)
+        if X.shape[0] == 0:
+            return self
+        self.count += X.shape[0]
+        self.sum += X.sum(axis=0)
+        self.min = np.minimum(self.min, X.min(axis=0))
+        self.max = np.maximum(self.max, X.max(axis=0))
+        cols = np.broadcast_to(np.arange(self.ncols), X.shape)
+        self.zeros += np.sum(X == 0, axis=0)
+        for sign in (1, -1):
+            mask = sign*X > 0
+            if not mask.any():
+                continue
+            keys = self._key(sign*X[mask])
+            offset = keys.min()
+            nkeys = keys.max() - offset + 1
+            flat = cols[mask]*nkeys + (keys - offset)
+            counts = np.bincount(flat, minlength=self.ncols*nkeys).reshape(self.ncols, nkeys)
+            self._add_counts(sign, offset, counts)
+        return self
+
+    def merge(self, other):
+        '''Adds the observations summarized by another sketch with the same accuracy'''
+        if other.ncols != self.ncols or other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('only sketches with the same columns and accuracy can be merged')
+        self.count += other.count
+        self.sum += other.sum
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.zeros += other.zeros
+        for sign in (1, -1):
+            offset, counts = other.stores[sign]
+            if counts.shape[1]:
+                self._add_counts(sign, offset, counts)
+        return self
+
+    def _buckets(self):
+        '''Bucket counts (ncols x nbuckets) and values of all buckets in increasing order'''
+        neg_offset, neg = self.stores[-1]
+        pos_offset, pos = self.stores[1]
+        values = np.concatenate((-self._value(neg_offset + np.arange(neg.shape[1]))[::-1], [0.0],
+                                 self._value(pos_offset + np.arange(pos.shape[1]))))
+        return np.hstack((neg[:, ::-1], self.zeros[:, None], pos)), values
+
+    def _at_rank(self, cum, values, rank):
+        '''Value of the observation of each column with the given 0-based rank'''
+        j = np.argmax(cum > rank[:, None], axis=1)
+        v = values[j]
+        # the exact extremes are known
+        return np.clip(v, self.min, self.max)
+
+    def quantile(self, q):
+        '''The q-quantile(s) of each column, interpolated between order statistics
+        like np.percentile; returns len(q) x ncols for a sequence q'''
+        counts, values = self._buckets()
+        cum = np.cumsum(counts, axis=1)
+        out = []
+        for qk in np.atleast_1d(q):
+            pos = qk*(self.count - 1)
+            lo = np.floor(pos)
+            v_lo = self._at_rank(cum, values, lo)
+            v_hi = self._at_rank(cum, values, np.ceil(pos))
+            out.append(v_lo + (pos - lo)*(v_hi - v_lo))
+        return np.array(out) if np.ndim(q) else out[0]
+
+    def box_stats(self, whis=1.5):
+        '''box_stats() of the observations. The quartiles, median and mean
+        are within relative_accuracy; the whisker ends within whisker_error().'''
+        q1, med, q3 = self.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        lo = q1 - whis*iqr
+        hi = q3 + whis*iqr
+        counts, values = self._buckets()
+        lower, upper = self._bounds(values)
+        occupied = counts > 0
+        # furthest occupied buckets that may hold data within the whisker
+        # limits, whose values are capped at the limits
+        inside_lo = occupied & (upper >= lo[:, None])
+        inside_hi = occupied & (lower <= hi[:, None])
+        whislo = np.maximum(values[np.argmax(inside_lo, axis=1)], lo)
+        whishi = np.minimum(values[counts.shape[1] - 1 - np.argmax(inside_hi[:, ::-1], axis=1)], hi)
+        whislo = np.where(self.min >= lo, self.min, whislo)
+        whishi = np.where(self.max <= hi, self.max, whishi)
+        return {'q1': q1, 'med': med, 'q3': q3, 'mean': self.sum / self.count,
+                'whislo': np.minimum(whislo, q1), 'whishi': np.maximum(whishi, q3)}
+
+    def whisker_error(self, whis=1.5):
+        '''Bounds on the absolute error of the 'whislo' and 'whishi' of box_stats().
+
+        A whisker limit, e.g. q3 + whis*IQR, moves by up to relative_accuracy*
+        ((1+whis)*|q3| + whis*|q1|) with the quartiles, which is about 2.4
+        times relative_accuracy of the limit for log-normal flows. Where the
+        data are dense around the limit, the whisker end is within that plus
+        relative_accuracy of itself; where they are sparse, it may stop at a
+        neighbouring observation of the exact one, which no bound covers.'''
+        a = self.relative_accuracy
+        stats = self.box_stats(whis)
+        q1, q3 = np.abs(stats['q1']), np.abs(stats['q3'])
+        return {'whislo': a*((1 + whis)*q1 + whis*q3 + np.abs(stats['whislo'])),
+                'whishi': a*((1 + whis)*q3 + whis*q1 + np.abs(stats['whishi']))}
+
+
+def sketch_box_stats(chunks, ncols, relative_accuracy=0.005, whis=1.5):
+    '''box_stats() of the columns of a sample given as an iterable of chunks'''
+    sketch = QuantileSketch(ncols, relative_accuracy)
+    for X in chunks:
+        sketch.update(X)
+    return sketch.box_stats(whis)
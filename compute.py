@@ -0,0 +1,77 @@
+'''Computes the validation statistics of the stationary or dynamic synthetic
+dataset and writes them as artifacts (see artifacts.py) for plotFDCrange.py,
+weekly-moments.py and internal_variability.py to render.
+
+Only NumPy is needed (scipy.special for the p-values), so this can run as a
+batch job without loading any plotting library:
+
+    python compute.py [stat|dyn]
+'''
+
+import sys
+
+from artifacts import artifact_path
+from convergence import write_convergence_artifact
+from correlation import write_correlation_artifact
+from extremes import write_extremes_artifact
+from fdc import write_fdc_artifact
+from instrument import stage
+from flows_by_site import all_sites
+from moments import write_moments_artifact
+
+spaces = ['real', 'log']
+
+
+def fdc_name(scenario):
+    '''Name of the FDC artifact of a scenario ('stat' or 'dyn')'''
+    return 'fdc-' + scenario
+
+
+def correlation_name(scenario, space):
+    '''Name of the cross-site and autocorrelation artifact of a scenario'''
+    return 'correlation-' + scenario + '-' + space
+
+
+def extremes_name(site, quantile, drought, scenario):
+    '''Name of the drought or flood severity-duration-frequency artifact of a site'''
+    return 'extremes-%s-q%g-%s-%s' % (site, quantile, 'drought' if drought else 'flood', scenario)
+
+
+def moments_name(site, scenario):
+    '''Name of the weekly moments artifact of a site'''
+    return 'moments-' + site + '-' + scenario
+
+
+def convergence_name(site, space, quantile, drought, scenario):
+    '''Name of the internal variability artifact of a site'''
+    return 'internal-variability-%s-%s-q%g-%s-%s' % (site, space, quantile,
+                                                       'drought' if drought else 'flood', scenario)
+
+
+def compute_all(scenario='stat', sites=all_sites, quantile=1.0, drought=False, num_syn_years=60,
+                chunk_years=None):
+    '''Writes the FDC and correlation artifacts, the drought and flood SDF
+    artifacts of every site and its moments and internal variability
+    artifacts in real and log space for one scenario'''
+    syn_datadir = 'synthetic-data-' + scenario
+    write_fdc_artifact(artifact_path(fdc_name(scenario)), 'historical-data/Qdaily-hist.csv',
+                       syn_datadir + '/Qdaily-syn-' + scenario + '.csv', chunk_years=chunk_years)
+    for space in spaces:
+        write_correlation_artifact(artifact_path(correlation_name(scenario, space)), 'historical-data/Qdaily-hist.csv',
+                                   syn_datadir + '/Qdaily-syn-' + scenario + '.csv', space=space)
+    for site in sites:
+        with stage('site', site=site, scenario=scenario):
+            write_moments_artifact(artifact_path(moments_name(site, scenario)), site,
+                                   syn_datadir=syn_datadir, num_syn_years=num_syn_years)
+            for extreme_quantile, extreme_drought in ((0.2, True), (0.8, False)):
+                write_extremes_artifact(artifact_path(extremes_name(site, extreme_quantile, extreme_drought,
+                                                                    scenario)),
+                                        site, syn_datadir=syn_datadir, num_syn_years=num_syn_years,
+                                        quantile=extreme_quantile, drought=extreme_drought)
+            for space in spaces:
+                write_convergence_artifact(artifact_path(convergence_name(site, space, quantile, drought, scenario)),
+                                           site, syn_datadir, num_syn_years, space, quantile, drought)
+
+
+if __name__ == '__main__':
+    compute_all(sys.argv[1] if len(sys.argv) > 1 else 'stat')
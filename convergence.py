@@ -0,0 +1,134 @@
+'''Convergence of the statistics of a synthetic ensemble with the number of
+realizations, as plotted by internal_variability.py.
+
+For each realization, the lowest (drought) or highest (flood) quantile*52
+weekly flows of every year are pooled, and their mean and standard deviation
+are taken. The mean and standard deviation of these per-realization
+statistics over the first n realizations are then computed for every n of a
+realization grid from cumulative sums, in a single pass.
+
+The extreme flows of the whole realization x year x week cube are selected
+with one np.partition call; since only their mean and standard deviation
+are used, they do not need to be fully sorted.
+'''
+
+import numpy as np
+
+from artifacts import save_artifact
+from boxstats import box_stats
+from ensemble import SyntheticEnsemble
+from flows_by_site import all_sites
+from instrument import instrumented
+from statcache import StatCache
+from stress_parallel import synthetic_sources
+
+
+@instrumented('sort')
+def extreme_flows(S, quantile=1.0, drought=True):
+    '''Returns the lowest (drought) or highest (flood) int(52*quantile) weekly
+    flows of each year of S (..., n_syn_years, 52), in no particular order'''
+    nq = int(S.shape[-1]*quantile)
+    if nq == 0 or nq >= S.shape[-1]:
+        return S[..., :nq]
+    if drought:
+        return np.partition(S, nq - 1, axis=-1)[..., :nq]
+    return np.partition(S, S.shape[-1] - nq, axis=-1)[..., S.shape[-1] - nq:]
+
+
+def prefix_moments(x, grid):
+    '''Mean and standard deviation of x[..., :n] along the last axis for each n in grid'''
+    # centre on the overall mean to avoid cancellation in E[x^2] - E[x]^2
+    x0 = x.mean(axis=-1, keepdims=True)
+    xc = x - x0
+    idx = np.asarray(grid) - 1
+    s1 = np.cumsum(xc, axis=-1)[..., idx]
+    s2 = np.cumsum(xc**2, axis=-1)[..., idx]
+    n = np.asarray(grid, dtype=float)
+    mean = s1 / n
+    return mean + x0, np.sqrt(np.maximum(s2 / n - mean**2, 0))
+
+
+@instrumented('convergence')
+def convergence_curves(S, quantile=1.0, drought=True, grid=None):
+    '''Convergence curves of S (..., n_realizations, n_syn_years, 52).
+
+    @param quantile The fraction of lowest/highest flows of each year to examine
+    @param drought True for the lowest flows, False for the highest flows
+    @param grid The numbers of realizations at which to evaluate the curves; all of 1..N by default
+
+    Returns a dict with the grid 'n', the per-realization 'means' and 'stds'
+    (..., n_realizations) and the curves 'mean_of_means', 'std_of_means',
+    'mean_of_stds' and 'std_of_stds' (..., len(grid)).
+    '''
+    nreal = S.shape[-3]
+    grid = np.arange(1, nreal + 1) if grid is None else np.asarray(grid)
+    if grid.size and (grid.min() < 1 or grid.max() > nreal):
+        raise ValueError('Realization grid must lie between 1 and ' + str(nreal))
+    X = extreme_flows(S, quantile, drought)
+    X = X.reshape(X.shape[:-2] + (-1,))
+    means = X.mean(axis=-1)
+    stds = X.std(axis=-1)
+    mean_of_means, std_of_means = prefix_moments(means, grid)
+    mean_of_stds, std_of_stds = prefix_moments(stds, grid)
+    return {'n': grid, 'means': means, 'stds': stds,
+            'mean_of_means': mean_of_means, 'std_of_means': std_of_means,
+            'mean_of_stds': mean_of_stds, 'std_of_stds': std_of_stds}
+
+
+def load_cube(site, syn_datadir='synthetic-data-stat', num_syn_years=60, space='real'):
+    '''Loads the n_realizations x n_syn_years x 52 synthetic cube of a site'''
+    S = SyntheticEnsemble(syn_datadir, num_syn_years, [site]).site_values(site)
+    return np.log(S) if space == 'log' else np.asarray(S)
+
+
+def site_convergence(sites=all_sites, syn_datadir='synthetic-data-stat', num_syn_years=60, space='real',
+                     quantile=1.0, drought=True, grid=None):
+    '''convergence_curves() of every site, stacked along a leading site axis'''
+    S = np.stack([load_cube(site, syn_datadir, num_syn_years, space) for site in sites])
+    return convergence_curves(S, quantile, drought, grid)
+
+
+@instrumented('internal-variability')
+def internal_variability_stats(S, quantile=1.0, drought=True, step=50):
+    '''The curves and boxplot statistics plotted by internal_variability.py for
+    every step-th number of realizations of S (n_realizations x n_syn_years x 52),
+    and for all of them'''
+    nreal = S.shape[0]
+    idx = np.arange(step, nreal + 1, step)   # realization indices
+    # small ensembles still get the point of the whole ensemble
+    if not idx.size or idx[-1] != nreal:
+        idx = np.append(idx, nreal)
+    curves = convergence_curves(S, quantile, drought, idx)
+    X = extreme_flows(S[idx-1], quantile, drought)
+    return {'n': idx, 'mean_of_means': curves['mean_of_means'], 'std_of_means': curves['std_of_means'],
+            'mean_of_stds': curves['mean_of_stds'], 'std_of_stds': curves['std_of_stds'],
+            'box': box_stats(np.reshape(X, (len(idx), -1)), axis=1)}
+
+
+def cached_internal_variability(site, syn_datadir='synthetic-data-stat', num_syn_years=60, space='real',
+                                quantile=1.0, drought=True, step=50, cache=None, data=None):
+    '''internal_variability_stats() of a site, read from the statcache.py
+    cache when the input files and parameters are unchanged.
+
+    @param cache A statcache.StatCache; the default cache if None
+    @param data A function returning the synthetic cube in this space, used
+                instead of load_cube() on a cache miss
+    '''
+    cache = StatCache() if cache is None else cache
+    params = {'site': site, 'num_syn_years': num_syn_years, 'space': space, 'quantile': quantile,
+              'drought': bool(drought), 'step': step}
+
+    def compute():
+        S = load_cube(site, syn_datadir, num_syn_years, space) if data is None else data()
+        return internal_variability_stats(S, quantile, drought, step)
+    return cache.cached('internal-variability', synthetic_sources(syn_datadir, site, num_syn_years), params,
+                        compute)
+
+
+def write_convergence_artifact(path, site, syn_datadir='synthetic-data-stat', num_syn_years=60, space='real',
+                               quantile=1.0, drought=True, step=50, cache=None):
+    '''Writes internal_variability_stats() of a site to an artifact'''
+    result = cached_internal_variability(site, syn_datadir, num_syn_years, space, quantile, drought, step, cache)
+    save_artifact(path, result, {'site': site, 'syn_datadir': syn_datadir, 'num_syn_years': num_syn_years,
+                                 'space': space, 'quantile': quantile, 'drought': drought})
+    return result
@@ -0,0 +1,187 @@
+'''Spatial and temporal correlation of the historical and synthetic records.
+
+STRESS draws the same bootstrap rows (Random_Matrix) for every site, which
+should preserve the correlation between sites, and stitches consecutive
+years with the U/U_shifted Cholesky factors, which should preserve the
+correlation between consecutive weeks. This module checks both on the
+Qdaily matrices written by flows_by_site.py (one column per site).
+
+The flows are deseasonalized by removing the mean and standard deviation of
+each week of each site (in real or log space). The cross-site correlation
+matrix and the lag-k autocorrelations are then computed with batched
+matrix products about these pooled moments, without re-centering each
+realization, which would bias short (e.g. one-year) realizations towards
+zero. The historical values are compared with the estimate pooled over all
+realizations and with the percentile range of the individual realizations.
+
+    python correlation.py [stat|dyn]
+'''
+
+import os
+import sys
+import numpy as np
+
+from artifacts import artifact_path, load_artifact, save_artifact
+from flows_by_site import all_sites
+from flowstore import load_flows, source_path
+from instrument import instrumented, stage
+from statcache import StatCache
+
+nweeks = 52
+default_lags = (1, 2, 3, 4)
+
+
+def weekly_cube(Qdaily, num_years=None):
+    '''Reshapes a Qdaily matrix into n_realizations x (num_years*52) x nsites.
+    The whole matrix is one realization if num_years is None.'''
+    Qdaily = np.asarray(Qdaily)
+    nrows = Qdaily.shape[0] if num_years is None else num_years*nweeks
+    return np.reshape(Qdaily, (-1, nrows, Qdaily.shape[1]))
+
+
+def deseasonalize(X, space='log'):
+    '''Standardizes each week of each site of X (n_realizations x nobs x
+    nsites) with its mean and standard deviation over all realizations and years'''
+    if space == 'log':
+        X = np.log(X)
+    W = np.reshape(X, (X.shape[0], -1, nweeks, X.shape[2]))
+    Z = (W - W.mean(axis=(0, 1))) / W.std(axis=(0, 1), ddof=1)
+    return np.reshape(Z, X.shape)
+
+
+def correlation_matrices(Z, pooled=False):
+    '''nsites x nsites correlation matrix of each realization of the
+    deseasonalized Z, or (1 x nsites x nsites) of all realizations pooled'''
+    C = np.einsum('rti,rtj->rij', Z, Z)
+    if pooled:
+        C = C.sum(axis=0, keepdims=True)
+    d = np.sqrt(np.diagonal(C, axis1=1, axis2=2))
+    return C / d[:, :, None] / d[:, None, :]
+
+
+def autocorrelations(Z, lags=default_lags, pooled=False):
+    '''Lag-k autocorrelation of each site of each realization of the
+    deseasonalized Z, as n_realizations x nlags x nsites, or (1 x nlags x
+    nsites) of all realizations pooled. Lagged products are averaged over
+    the nobs-k pairs of each lag.'''
+    nobs = Z.shape[1]
+    var = np.einsum('rti,rti->ri', Z, Z) / nobs
+    acf = np.empty((Z.shape[0], len(lags), Z.shape[2]))
+    for i, k in enumerate(lags):
+        acf[:, i, :] = np.einsum('rti,rti->ri', Z[:, k:], Z[:, :-k]) / (nobs - k)
+    if pooled:
+        return acf.sum(axis=0, keepdims=True) / var.sum(axis=0)[None, None, :]
+    return acf / var[:, None, :]
+
+
+@instrumented('correlation')
+def correlation_stats(Qdaily_hist, Qdaily_syn, num_syn_years=1, space='log', lags=default_lags,
+                      percentiles=(2.5, 97.5)):
+    '''Cross-site correlations and autocorrelations of the historical record
+    and of each synthetic realization.
+
+    Returns the historical 'corr' (nsites x nsites) and 'acf' (nlags x
+    nsites), their synthetic estimates 'pooled' over all realizations, the
+    'mean', 'lo' and 'hi' percentiles of the estimates of the individual
+    realizations and whether the historical values fall between these.'''
+    lags = [k for k in lags if k < num_syn_years*nweeks]
+    H = deseasonalize(weekly_cube(Qdaily_hist), space)
+    S = deseasonalize(weekly_cube(Qdaily_syn, num_syn_years), space)
+    stats = {'lags': np.asarray(lags),
+             'hist': {'corr': correlation_matrices(H, True)[0], 'acf': autocorrelations(H, lags, True)[0]},
+             'syn': {}, 'covered': {}}
+    for name, f in (('corr', correlation_matrices), ('acf', lambda Z, pooled: autocorrelations(Z, lags, pooled))):
+        X = f(S, False)
+        lo, hi = np.percentile(X, percentiles, axis=0)
+        stats['syn'][name] = {'pooled': f(S, True)[0], 'mean': X.mean(axis=0), 'lo': lo, 'hi': hi}
+        stats['covered'][name] = (lo <= stats['hist'][name]) & (stats['hist'][name] <= hi)
+    return stats
+
+
+def cached_correlation_stats(hist_path, syn_path, num_syn_years=1, space='log', lags=default_lags, cache=None,
+                             data=None):
+    '''correlation_stats() of two Qdaily matrices, read from the statcache.py
+    cache when the files have not changed.
+
+    @param data A function returning the historical and synthetic Qdaily
+                matrices, used instead of loading them on a cache miss
+    '''
+    cache = StatCache() if cache is None else cache
+    params = {'num_syn_years': num_syn_years, 'space': space, 'lags': list(lags), 'estimator': 'pooled'}
+
+    def compute():
+        Qdaily_hist, Qdaily_syn = (load_flows(hist_path), load_flows(syn_path)) if data is None else data()
+        return correlation_stats(Qdaily_hist, Qdaily_syn, num_syn_years, space, lags)
+    return cache.cached('correlation', [source_path(hist_path), source_path(syn_path)], params, compute)
+
+
+def write_correlation_artifact(path, hist_path, syn_path, num_syn_years=1, space='log', lags=default_lags,
+                               cache=None, data=None):
+    '''Writes the correlation statistics to the artifact read by render_correlation()'''
+    stats = cached_correlation_stats(hist_path, syn_path, num_syn_years, space, lags, cache, data)
+    save_artifact(path, stats, {'hist': hist_path, 'syn': syn_path, 'num_syn_years': num_syn_years,
+                                'space': space})
+    return stats
+
+
+def summary_table(stats, sites=all_sites):
+    '''One line per site: the mean absolute difference between its historical
+    and pooled synthetic correlations with the other sites, the share of these
+    inside the synthetic range, and the historical and synthetic autocorrelations'''
+    corr_diff = np.abs(stats['syn']['corr']['pooled'] - stats['hist']['corr'])
+    covered = stats['covered']['corr']
+    nsites = len(sites)
+    off = ~np.eye(nsites, dtype=bool)
+    lines = ['%-34s %9s %8s' % ('site', '|dcorr|', 'covered') +
+             ''.join(' %13s' % ('acf%d hist/syn' % k) for k in stats['lags'])]
+    for j, site in enumerate(sites):
+        line = '%-34s %9.3f %7.0f%%' % (site, corr_diff[j, off[j]].mean(), 100*covered[j, off[j]].mean())
+        for i in range(len(stats['lags'])):
+            line = line + '   %5.2f/%5.2f' % (stats['hist']['acf'][i, j], stats['syn']['acf']['pooled'][i, j])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+@instrumented('plot')
+def render_correlation(path, sitenames, fig_name):
+    '''Draws the historical and pooled synthetic correlation matrices of an
+    artifact and their difference as heatmaps'''
+    from matplotlib import pyplot as plt
+
+    stats, meta = load_artifact(path)
+    panels = [('Historical', stats['hist']['corr'], 'viridis', (0, 1)),
+              ('Synthetic (pooled)', stats['syn']['corr']['pooled'], 'viridis', (0, 1)),
+              ('Synthetic - historical', stats['syn']['corr']['pooled'] - stats['hist']['corr'], 'RdBu_r', (-0.2, 0.2))]
+    fig, axes = plt.subplots(1, 3, figsize=(24, 8))
+    for ax, (title, C, cmap, (vmin, vmax)) in zip(axes, panels):
+        im = ax.imshow(C, cmap=cmap, vmin=vmin, vmax=vmax)
+        ax.set_xticks(range(len(sitenames)))
+        ax.set_xticklabels(sitenames, rotation=90)
+        ax.set_yticks(range(len(sitenames)))
+        ax.set_yticklabels(sitenames if ax is axes[0] else [])
+        ax.set_title(title)
+        fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+    fig.suptitle('Cross-site correlation of deseasonalized %s flows' % meta.get('space', 'log'))
+    fig.tight_layout()
+    # render workers may run before anything else has created the directory
+    os.makedirs(os.path.dirname(fig_name) or '.', exist_ok=True)
+    with stage('savefig', figure=fig_name):
+        fig.savefig(fig_name)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    from compute import correlation_name
+    from plotFDCrange import all_sitenames, assure_path_exists
+
+    scenario = sys.argv[1] if len(sys.argv) > 1 else 'stat'  # modify based on stationary or dynamic dataset
+    space = 'log'
+    plot = True     # also draw the correlation heatmaps
+
+    path = artifact_path(correlation_name(scenario, space))
+    stats = write_correlation_artifact(path, 'historical-data/Qdaily-hist.csv',
+                                       'synthetic-data-' + scenario + '/Qdaily-syn-' + scenario + '.csv', space=space)
+    print(summary_table(stats))
+    if plot:
+        assure_path_exists('figures/')
+        render_correlation(path, all_sitenames, 'figures/correlation-' + scenario + '-' + space + '.pdf')
@@ -0,0 +1,170 @@
+'''Indexed view of a synthetic ensemble as a site x realization x year x week
+cube.
+
+The <site>_SYNxx records (or their stress_parallel.py shards) hold one row
+per realization and num_syn_years*nweeks columns, where the number of weeks
+per year is inferred from the width of the files. A SyntheticEnsemble maps each
+file copy-on-write and reshapes it into realization x year x week without
+reading it. Selecting along the named axes only narrows index arrays, and
+values() then touches just the rows and columns that were selected, e.g.
+
+    ens = SyntheticEnsemble('synthetic-data-stat', 60)
+    week30 = ens.sel(site=['trainingOWASAInflow', 'trainingMichieInflow'], week=29).values()
+
+reads week 30 of every year and realization of two sites. Files without an
+up-to-date binary copy (see flowstore.py) are parsed in full the first time
+they are read.
+'''
+
+import numpy as np
+
+from flows_by_site import all_sites
+from flowstore import flow_shape, load_flows
+from instrument import add_bytes, stage
+from stress import synthetic_filename
+from stress_parallel import read_manifest
+
+dims = ('site', 'realization', 'year', 'week')
+
+
+def _as_slice(idx):
+    '''A slice equivalent to an index array with a constant positive step, else the array'''
+    if len(idx) == 0:
+        return idx
+    if len(idx) == 1:
+        return slice(int(idx[0]), int(idx[0]) + 1)
+    step = idx[1] - idx[0]
+    if step > 0 and np.all(np.diff(idx) == step):
+        return slice(int(idx[0]), int(idx[-1]) + 1, int(step))
+    return idx
+
+
+def _take(X, index):
+    '''X[index[0], index[1], ...] with one index per axis, reading only the
+    selected elements of a memory map'''
+    key = tuple(_as_slice(idx) for idx in index)
+    X = X[tuple(k if isinstance(k, slice) else slice(None) for k in key)]
+    for axis, k in enumerate(key):
+        if not isinstance(k, slice):
+            X = np.take(X, k, axis=axis)
+    return X
+
+
+class SyntheticEnsemble(object):
+    '''Lazily sliced site x realization x year x week view of the SYNxx records of datadir
+
+    @param datadir The directory of the <site>_SYNxx files or of their shards
+    @param num_syn_years The number of synthetic years of each realization
+    @param sites The sites on the site axis
+    '''
+
+    def __init__(self, datadir='synthetic-data-stat', num_syn_years=60, sites=all_sites):
+        self.datadir = datadir
+        self.num_syn_years = num_syn_years
+        manifest = read_manifest(datadir, num_syn_years)
+        if manifest is None:
+            self._blocks = {site: [(0, synthetic_filename(datadir, site, num_syn_years))] for site in sites}
+            nreal, ncols = flow_shape(synthetic_filename(datadir, sites[0], num_syn_years))
+        else:
+            self._blocks = {site: [(shard['start'], datadir + '/' + shard['files'][site])
+                                   for shard in manifest['shards']] for site in sites}
+            nreal, ncols = manifest['num_realizations'], flow_shape(self._blocks[sites[0]][0][1])[1]
+        if ncols % num_syn_years:
+            raise ValueError(datadir + ' has ' + str(ncols) + ' weeks per realization, not a multiple of ' +
+                             str(num_syn_years) + ' years')
+        self.nweeks = ncols // num_syn_years
+        self._stops = [start for start, path in self._blocks[sites[0]][1:]] + [nreal]
+        self._maps = {}
+        self._index = {'site': list(sites), 'realization': np.arange(nreal),
+                       'year': np.arange(num_syn_years), 'week': np.arange(self.nweeks)}
+
+    @property
+    def sites(self):
+        return list(self._index['site'])
+
+    @property
+    def coords(self):
+        '''The site names and the realization, year and week indices on each axis'''
+        return dict(self._index)
+
+    @property
+    def shape(self):
+        return tuple(len(self._index[dim]) for dim in dims)
+
+    def _view(self, index):
+        view = object.__new__(SyntheticEnsemble)
+        view.__dict__.update(self.__dict__)
+        view._index = index
+        return view
+
+    def sel(self, site=None, realization=None, year=None, week=None):
+        '''A view of a subset of the ensemble; nothing is read.
+
+        @param site A site name or a list of site names
+        @param realization, year, week An index, slice, list of indices or boolean
+        mask relative to the current view; integer selections keep their axis
+        '''
+        index = dict(self._index)
+        if site is not None:
+            for s in [site] if isinstance(site, str) else site:
+                if s not in self._blocks:
+                    raise KeyError(s)
+            index['site'] = [site] if isinstance(site, str) else list(site)
+        for dim, selector in (('realization', realization), ('year', year), ('week', week)):
+            if selector is not None:
+                index[dim] = np.atleast_1d(index[dim][selector])
+        return self._view(index)
+
+    def realizations(self, num_realizations, seed=None):
+        '''A view of a random subset of num_realizations realizations, kept in order'''
+        rng = np.random.default_rng(seed)
+        picked = rng.choice(self.shape[1], size=num_realizations, replace=False)
+        return self.sel(realization=np.sort(picked))
+
+    def _map(self, path):
+        if path not in self._maps:
+            Q = load_flows(path)
+            self._maps[path] = np.reshape(Q, (Q.shape[0], -1, self.nweeks))
+        return self._maps[path]
+
+    def site_values(self, site):
+        '''The selected realization x year x week cube of one site. A selection
+        inside a single file is returned as a view of its memory map.'''
+        with stage('select', site=site):
+            X = self._site_values(site)
+            # views of a memory map were counted by its load; copies are read here
+            if not any(np.may_share_memory(X, Q) for Q in self._maps.values()):
+                add_bytes(X.nbytes)
+            return X
+
+    def _site_values(self, site):
+        rows = self._index['realization']
+        parts = []
+        positions = []
+        for (start, path), stop in zip(self._blocks[site], self._stops):
+            inside = np.flatnonzero((rows >= start) & (rows < stop))
+            if len(inside) > 0:
+                parts.append(_take(self._map(path), [rows[inside] - start, self._index['year'],
+                                                     self._index['week']]))
+                positions.append(inside)
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.empty((0, len(self._index['year']), len(self._index['week'])))
+        X = np.concatenate(parts, axis=0)
+        # restore the requested order of realizations spread over several shards
+        order = np.concatenate(positions)
+        if np.any(np.diff(order) < 0):
+            X = X[np.argsort(order)]
+        return X
+
+    def values(self):
+        '''Reads the selection as a site x realization x year x week array'''
+        sites = self._index['site']
+        if len(sites) == 1:
+            return self.site_values(sites[0])[None]
+        return np.stack([self.site_values(site) for site in sites])
+
+    def __array__(self, dtype=None):
+        X = self.values()
+        return X if dtype is None else X.astype(dtype)
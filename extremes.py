@@ -0,0 +1,251 @@
+'''Drought and flood events: run lengths, deficits and severity-duration-
+frequency (SDF) curves of the historical and synthetic records.
+
+An event is a run of consecutive weeks whose flow is below (drought) or
+above (flood) the given quantile of the historical flows of the same week.
+Its duration is the number of weeks in the run and its severity the
+cumulative deficit (drought) or excess (flood) over the threshold.
+
+Runs are found in the whole realization x week array at once from the
+edges of the exceedance mask, and severities from differences of its
+cumulative sum, so there is no loop over realizations or events. Synthetic
+ensembles are read in chunks of realizations to bound memory.
+
+The SDF curve gives, for each duration D and return period T, the severity
+exceeded on average once every T years by the events lasting at least D
+weeks, i.e. the (num_years/T)-th largest of their severities.
+
+    python extremes.py [stat|dyn]
+'''
+
+import os
+import sys
+import numpy as np
+
+from artifacts import load_artifact, save_artifact
+from boxstats import box_stats
+from ensemble import SyntheticEnsemble
+from flowstore import load_flows, source_path
+from instrument import instrumented, stage
+from statcache import StatCache
+from stress_parallel import synthetic_sources
+
+nweeks = 52
+default_durations = (1, 2, 4, 8, 13, 26, 52)
+default_return_periods = (2, 5, 10, 20, 50)
+
+
+def weekly_thresholds(H, quantile=0.2):
+    '''The quantile of the historical flows H (nhist_years x 52) of each week'''
+    return np.percentile(H, 100*quantile, axis=0)
+
+
+def deficits(X, thresholds, drought=True):
+    '''Deficit below (drought) or excess over (flood) the weekly thresholds of
+    X (n_realizations x n_years x 52), as n_realizations x (n_years*52)'''
+    D = thresholds - X if drought else X - thresholds
+    return np.reshape(D, (D.shape[0], -1))
+
+
+@instrumented('runs')
+def find_runs(D):
+    '''Runs of positive values in each row of D (n_realizations x nweeks).
+
+    Returns arrays with one entry per run, in realization and time order:
+    its 'realization', 'start' week, 'duration' in weeks, 'severity' (sum of
+    D over the run) and 'peak' (maximum of D over the run).'''
+    R, T = D.shape
+    inside = D > 0
+    padded = np.zeros((R, T + 2), dtype=np.int8)
+    padded[:, 1:-1] = inside
+    edges = np.diff(padded, axis=1)
+    r, start = np.nonzero(edges == 1)
+    stop = np.nonzero(edges == -1)[1]
+    cs = np.zeros((R, T + 1))
+    np.cumsum(np.where(inside, D, 0.0), axis=1, out=cs[:, 1:])
+    flat = np.reshape(D, -1)
+    # every value between the end of a run and the start of the next is <= 0
+    peak = np.maximum.reduceat(flat, r*T + start) if len(r) else np.empty(0)
+    return {'realization': r, 'start': start, 'duration': stop - start,
+            'severity': cs[r, stop] - cs[r, start], 'peak': peak}
+
+
+def _chunks(S, chunk_realizations):
+    '''Yields (first realization, cube) chunks of an array or a single-site SyntheticEnsemble'''
+    for a in range(0, S.shape[-3], chunk_realizations):
+        if isinstance(S, SyntheticEnsemble):
+            yield a, S.sel(realization=slice(a, a + chunk_realizations)).values()[0]
+        else:
+            yield a, S[a:a + chunk_realizations]
+
+
+def find_events(S, thresholds, drought=True, chunk_realizations=1000):
+    '''find_runs() of every realization of S (n_realizations x n_years x 52,
+    or a single-site SyntheticEnsemble), read chunk_realizations at a time'''
+    parts = []
+    for a, X in _chunks(S, chunk_realizations):
+        events = find_runs(deficits(np.asarray(X), thresholds, drought))
+        events['realization'] = events['realization'] + a
+        parts.append(events)
+    return {key: np.concatenate([events[key] for events in parts]) for key in parts[0]}
+
+
+def _sdf_ranks(num_years, return_periods):
+    '''Rank (from 1) of the severity with each return period; 0 if it exceeds the record'''
+    return np.floor(num_years / np.asarray(return_periods, dtype=float)).astype(int)
+
+
+def sdf_curve(events, num_years, durations=default_durations, return_periods=default_return_periods):
+    '''Pooled SDF curve (ndurations x nreturn_periods) of events covering
+    num_years years; NaN where the return period is longer than the record'''
+    ranks = _sdf_ranks(num_years, return_periods)
+    sdf = np.full((len(durations), len(ranks)), np.nan)
+    for i, d in enumerate(durations):
+        s = -np.sort(-events['severity'][events['duration'] >= d])
+        # the severity is 0 when fewer events than the rank last this long
+        padded = np.concatenate((s, [0.0]))
+        idx = np.clip(ranks, 1, len(s) + 1) - 1
+        sdf[i] = np.where(ranks >= 1, padded[idx], np.nan)
+    return sdf
+
+
+def sdf_by_realization(events, num_realizations, num_years, durations=default_durations,
+                       return_periods=default_return_periods):
+    '''SDF curve of each realization (n_realizations x ndurations x
+    nreturn_periods), from one sort of all events by realization and severity'''
+    ranks = _sdf_ranks(num_years, return_periods)
+    order = np.lexsort((-events['severity'], events['realization']))
+    r = events['realization'][order]
+    severity = events['severity'][order]
+    duration = events['duration'][order]
+    sdf = np.zeros((num_realizations, len(durations), len(ranks)))
+    sdf[:, :, ranks < 1] = np.nan
+    for i, d in enumerate(durations):
+        keep = duration >= d
+        rk, sk = r[keep], severity[keep]
+        counts = np.bincount(rk, minlength=num_realizations)
+        rank = np.arange(len(rk)) - (np.cumsum(counts) - counts)[rk] + 1
+        for j, k in enumerate(ranks):
+            if k >= 1:
+                hit = rank == k
+                sdf[rk[hit], i, j] = sk[hit]
+    return sdf
+
+
+def event_counts(events, num_realizations):
+    '''Number of events and longest event of each realization'''
+    counts = np.bincount(events['realization'], minlength=num_realizations)
+    longest = np.zeros(num_realizations, dtype=int)
+    np.maximum.at(longest, events['realization'], events['duration'])
+    return counts, longest
+
+
+@instrumented('extremes')
+def site_extremes(H, S, quantile=0.2, drought=True, durations=default_durations,
+                  return_periods=default_return_periods, chunk_realizations=1000):
+    '''SDF curves and event statistics of the historical record H
+    (nhist_years x 52) and the synthetic record S (n_realizations x
+    n_syn_years x 52, or a single-site SyntheticEnsemble) of one site.
+
+    The synthetic 'sdf' is pooled over all realizations; 'lo', 'med' and
+    'hi' are the 5th, 50th and 95th percentiles of the SDF curves of the
+    individual realizations. 'events_per_year' and 'longest' are box
+    statistics (see boxstats.py) over the realizations.'''
+    thresholds = weekly_thresholds(H, quantile)
+    nreal, nyears = S.shape[-3], S.shape[-2]
+    hist_events = find_runs(deficits(np.asarray(H)[None], thresholds, drought))
+    syn_events = find_events(S, thresholds, drought, chunk_realizations)
+    counts, longest = event_counts(syn_events, nreal)
+    per_realization = sdf_by_realization(syn_events, nreal, nyears, durations, return_periods)
+    # return periods longer than a realization are left as NaN
+    valid = _sdf_ranks(nyears, return_periods) >= 1
+    lo, med, hi = np.full((3, len(durations), len(return_periods)), np.nan)
+    lo[:, valid], med[:, valid], hi[:, valid] = np.percentile(per_realization[:, :, valid], [5, 50, 95], axis=0)
+    return {'durations': np.asarray(durations), 'return_periods': np.asarray(return_periods),
+            'thresholds': thresholds,
+            'hist': {'sdf': sdf_curve(hist_events, H.shape[0], durations, return_periods),
+                     'events_per_year': len(hist_events['duration']) / H.shape[0],
+                     'longest': hist_events['duration'].max() if len(hist_events['duration']) else 0},
+            'syn': {'sdf': sdf_curve(syn_events, nreal*nyears, durations, return_periods),
+                    'lo': lo, 'med': med, 'hi': hi,
+                    'events_per_year': box_stats(counts / nyears),
+                    'longest': box_stats(longest)}}
+
+
+def cached_site_extremes(site, hist_datadir='historical-data', syn_datadir='synthetic-data-stat', num_syn_years=60,
+                         quantile=0.2, drought=True, cache=None, data=None):
+    '''site_extremes() of a site, read from the statcache.py cache when the
+    input files and parameters are unchanged.
+
+    @param data A function returning the historical and synthetic records,
+                used instead of reading them in chunks on a cache miss
+    '''
+    cache = StatCache() if cache is None else cache
+    hist_path = hist_datadir + '/' + site + '.csv'
+    params = {'site': site, 'num_syn_years': num_syn_years, 'quantile': quantile, 'drought': bool(drought),
+              'durations': list(default_durations), 'return_periods': list(default_return_periods)}
+
+    def compute():
+        if data is None:
+            H = load_flows(hist_path)
+            S = SyntheticEnsemble(syn_datadir, num_syn_years, [site])
+        else:
+            H, S = data()
+        return site_extremes(H, S, quantile, drought)
+    inputs = [source_path(hist_path)] + synthetic_sources(syn_datadir, site, num_syn_years)
+    return cache.cached('extremes', inputs, params, compute)
+
+
+def write_extremes_artifact(path, site, hist_datadir='historical-data', syn_datadir='synthetic-data-stat',
+                            num_syn_years=60, quantile=0.2, drought=True, cache=None):
+    '''Writes site_extremes() of a site to an artifact'''
+    result = cached_site_extremes(site, hist_datadir, syn_datadir, num_syn_years, quantile, drought, cache)
+    save_artifact(path, result, {'site': site, 'syn_datadir': syn_datadir, 'num_syn_years': num_syn_years,
+                                 'quantile': quantile, 'drought': drought})
+    return result
+
+
+@instrumented('plot')
+def render_sdf(path, sitename, fig_name):
+    '''Plots the historical and synthetic severity-duration-frequency curves
+    of an artifact, one color per return period'''
+    from matplotlib import pyplot as plt
+
+    result, meta = load_artifact(path)
+    durations = result['durations']
+    fig, ax = plt.subplots(figsize=(10, 7))
+    for j, T in enumerate(result['return_periods']):
+        color = 'C%d' % j
+        ax.fill_between(durations, result['syn']['lo'][:, j], result['syn']['hi'][:, j], color=color, alpha=0.2)
+        ax.plot(durations, result['syn']['sdf'][:, j], color=color, label='%g-year' % T)
+        ax.plot(durations, result['hist']['sdf'][:, j], color=color, ls='--', marker='o')
+    ax.set_xscale('log')
+    ax.set_xlabel('Duration (weeks)')
+    ax.set_ylabel('%s ($10^{6}$ gal)' % ('Cumulative deficit' if meta['drought'] else 'Cumulative excess'))
+    ax.set_title('%s: %s severity-duration-frequency\n(solid: synthetic, dashed: historical)'
+                 % (sitename, 'drought' if meta['drought'] else 'flood'))
+    ax.legend(title='Return period')
+    # render workers may run before anything else has created the directory
+    os.makedirs(os.path.dirname(fig_name) or '.', exist_ok=True)
+    with stage('savefig', figure=fig_name):
+        fig.savefig(fig_name)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    from artifacts import artifact_path
+    from compute import extremes_name
+    from flows_by_site import all_sites
+    from plotFDCrange import all_sitenames, assure_path_exists
+
+    scenario = sys.argv[1] if len(sys.argv) > 1 else 'stat'  # modify based on stationary or dynamic dataset
+    drought = True
+    quantile = 0.2 if drought else 0.8     # weekly threshold, as a quantile of the historical flows
+
+    assure_path_exists('figures/')
+    for site, sitename in zip(all_sites, all_sitenames):
+        path = artifact_path(extremes_name(site, quantile, drought, scenario))
+        write_extremes_artifact(path, site, syn_datadir='synthetic-data-' + scenario, quantile=quantile,
+                                drought=drought)
+        render_sdf(path, sitename, 'figures/sdf-' + site + '-' + ('drought' if drought else 'flood') + '-' +
+                   scenario + '.pdf')
@@ -0,0 +1,170 @@
+'''Vectorized flow duration curves (FDCs) and their envelopes.
+
+flow_duration_curves() sorts the weeks of every year of every site of a
+Qdaily matrix (one column per site, written by flows_by_site.py) in one call.
+fdc_envelopes() reduces them to the min/max/percentile envelopes drawn by
+plotFDCrange.py, and cached_fdc_envelopes() stores these in the statcache.py
+cache keyed on the contents of the input file, so that re-rendering a figure
+does not recompute them.
+
+streaming_fdc_envelopes() computes the same envelopes from a Qdaily matrix
+read in chunks of years, so that peak memory is bounded by the chunk size
+rather than by the number of realizations. Its min/max envelopes are exact;
+its percentiles are interpolated between order statistics read from
+log-spaced histograms, each accurate to within one of nbins histogram bins.
+'''
+
+import itertools
+import numpy as np
+
+from artifacts import save_artifact
+from flowstore import csv_path, has_binary, load_flows, source_path
+from instrument import instrumented
+from statcache import StatCache
+
+nweeks = 52
+default_percentiles = (10, 50, 90)
+
+
+def exceedance(n=nweeks):
+    '''Probability of exceedance of each position of an n-week FDC'''
+    M = np.arange(1, n+1)
+    return (M-0.5)/n
+
+
+@instrumented('sort')
+def flow_duration_curves(Qdaily, n=nweeks):
+    '''Returns the nsites x nyears x n FDCs (each year sorted in decreasing
+    order) of a nyears*n x nsites Qdaily matrix'''
+    Qdaily = np.asarray(Qdaily)
+    if Qdaily.ndim == 1:
+        Qdaily = Qdaily[:, None]
+    nsites = Qdaily.shape[1]
+    q = np.reshape(Qdaily.T, (nsites, Qdaily.shape[0]//n, n))
+    fdc = np.sort(q, axis=2)
+    return fdc[:, :, ::-1]
+
+
+@instrumented('fdc')
+def fdc_envelopes(Qdaily, percentiles=default_percentiles, n=nweeks):
+    '''Returns a dict with the exceedance probabilities 'P' and the 'min',
+    'max' (nsites x n) and 'percentiles' (npercentiles x nsites x n)
+    envelopes of the FDCs of all years of a Qdaily matrix'''
+    fdc = flow_duration_curves(Qdaily, n)
+    q = np.asarray(percentiles, dtype=float)
+    return {'P': exceedance(n), 'min': fdc.min(axis=1), 'max': fdc.max(axis=1),
+            'q': q, 'percentiles': np.percentile(fdc, q, axis=1)}
+
+
+def iter_year_chunks(path, chunk_years=1000, n=nweeks):
+    '''Yields the Qdaily matrix at path in blocks of chunk_years whole years,
+    slicing its memory-mapped binary copy or parsing its CSV file chunk by chunk'''
+    nrows = chunk_years*n
+    if has_binary(path):
+        Qdaily = load_flows(path, mmap_mode='r')
+        for start in range(0, Qdaily.shape[0], nrows):
+            yield Qdaily[start:start + nrows]
+        return
+    with open(csv_path(path)) as f:
+        while True:
+            lines = list(itertools.islice(f, nrows))
+            if not lines:
+                return
+            yield np.loadtxt(lines, delimiter=',', ndmin=2)
+
+
+def _histogram_percentiles(chunks, q, fdc_min, fdc_max, n, nbins):
+    '''Percentiles of the FDCs in chunks from per-(site, position) histograms
+    with nbins bins between fdc_min and fdc_max'''
+    # log-spaced bins for strictly positive flows
+    log = np.all(fdc_min > 0)
+    transform = np.log if log else np.asarray
+    lo = transform(fdc_min)
+    width = (transform(fdc_max) - lo) / nbins
+    width[width == 0] = 1.0
+
+    counts = np.zeros(fdc_min.shape + (nbins,), dtype=np.int64)
+    offsets = (np.arange(fdc_min.size).reshape(fdc_min.shape) * nbins)[:, None, :]
+    total = 0
+    for Qdaily in chunks:
+        fdc = flow_duration_curves(Qdaily, n)
+        k = np.clip(((transform(fdc) - lo[:, None, :]) / width[:, None, :]).astype(np.int64), 0, nbins-1)
+        counts += np.bincount((offsets + k).ravel(), minlength=counts.size).reshape(counts.shape)
+        total = total + fdc.shape[1]
+
+    cum = np.cumsum(counts, axis=-1)
+
+    def order_statistic(r):
+        '''Element of rank r, spread uniformly within the bin holding it'''
+        kbin = np.sum(cum <= r, axis=-1)[..., None]
+        below = np.where(kbin > 0, np.take_along_axis(cum, np.maximum(kbin - 1, 0), axis=-1), 0)
+        frac = (r - below + 0.5) / np.take_along_axis(counts, kbin, axis=-1)
+        value = lo + (kbin[..., 0] + frac[..., 0]) * width
+        value = np.exp(value) if log else value
+        return np.clip(value, fdc_min, fdc_max)
+
+    # interpolate between the order statistics around the (fractional) rank
+    # h, as in np.percentile's linear method
+    result = np.empty((len(q),) + fdc_min.shape)
+    for i in range(len(q)):
+        h = (total - 1) * q[i] / 100.0
+        below = order_statistic(np.floor(h))
+        above = order_statistic(np.ceil(h))
+        result[i] = below + (h - np.floor(h)) * (above - below)
+    return result
+
+
+@instrumented('fdc')
+def streaming_fdc_envelopes(path, percentiles=default_percentiles, n=nweeks, chunk_years=1000, nbins=4096):
+    '''fdc_envelopes() of the Qdaily matrix at path, computed from chunks of
+    chunk_years years. A second pass over the file is made if percentiles
+    are requested.'''
+    fdc_min = None
+    fdc_max = None
+    for Qdaily in iter_year_chunks(path, chunk_years, n):
+        fdc = flow_duration_curves(Qdaily, n)
+        if fdc_min is None:
+            fdc_min = fdc.min(axis=1)
+            fdc_max = fdc.max(axis=1)
+        else:
+            np.minimum(fdc_min, fdc.min(axis=1), out=fdc_min)
+            np.maximum(fdc_max, fdc.max(axis=1), out=fdc_max)
+
+    q = np.asarray(percentiles, dtype=float)
+    if len(q):
+        pct = _histogram_percentiles(iter_year_chunks(path, chunk_years, n), q, fdc_min, fdc_max, n, nbins)
+    else:
+        pct = np.empty((0,) + fdc_min.shape)
+    return {'P': exceedance(n), 'min': fdc_min, 'max': fdc_max, 'q': q, 'percentiles': pct}
+
+
+def cached_fdc_envelopes(path, percentiles=default_percentiles, n=nweeks, cache=None, chunk_years=None,
+                         data=None):
+    '''fdc_envelopes() of the Qdaily matrix at path, read from the cache when
+    they have already been computed for the current contents of the file.
+
+    @param cache A statcache.StatCache; the default cache if None
+    @param chunk_years If given, the envelopes are computed by streaming_fdc_envelopes()
+    @param data A function returning the Qdaily matrix, used instead of
+                loading path on a cache miss
+    '''
+    cache = StatCache() if cache is None else cache
+    streaming = chunk_years is not None
+    params = {'percentiles': [float(q) for q in percentiles], 'n': n, 'streaming': streaming}
+
+    def compute():
+        if streaming:
+            return streaming_fdc_envelopes(path, percentiles, n, chunk_years)
+        return fdc_envelopes(load_flows(path) if data is None else data(), percentiles, n)
+    return cache.cached('fdc', [source_path(path)], params, compute)
+
+
+def write_fdc_artifact(path, hist_path, syn_path, percentiles=default_percentiles, chunk_years=None,
+                       cache=None, hist_data=None, syn_data=None):
+    '''Writes the FDC envelopes of the historical and synthetic Qdaily matrices
+    to the artifact read by plotFDCrange.py. hist_data and syn_data are the
+    data functions of cached_fdc_envelopes().'''
+    env = {'hist': cached_fdc_envelopes(hist_path, percentiles, cache=cache, data=hist_data),
+           'syn': cached_fdc_envelopes(syn_path, percentiles, cache=cache, chunk_years=chunk_years, data=syn_data)}
+    save_artifact(path, env, {'hist': hist_path, 'syn': syn_path, 'percentiles': list(percentiles)})
+    return env
@@ -0,0 +1,136 @@
+'''Synthetic fixture datasets in the layout of the real data directories.
+
+Writes log-normal weekly flows with a seasonal cycle, correlation between
+sites and week-to-week persistence, at any number of sites, historical
+years, realizations and synthetic years, as
+
+    <root>/historical-data/<site>.csv                  nhist_years x 52
+    <root>/historical-data/Qdaily-hist.csv             (nhist_years*52) x nsites
+    <root>/synthetic-data-<scenario>/<site>_SYNxx.csv  n_realizations x (num_syn_years*52)
+    <root>/synthetic-data-<scenario>/Qdaily-syn-<scenario>.csv
+
+for the stationary ('stat') and dynamic ('dyn', wetter) scenarios. Files are
+written in the flowstore.py binary format (.npy plus .json header) and, if
+csv is True, also as CSV. Synthetic realizations are generated and written
+chunk_realizations at a time, so memory does not grow with the ensemble. The sites are named as in flows_by_site.py, and
+numbered beyond its ten sites.
+
+    python fixtures.py [--csv] [root [nsites num_realizations nhist_years]]
+'''
+
+import json
+import os
+import sys
+import numpy as np
+
+from flows_by_site import all_sites, ingest_historical, ingest_synthetic
+from flowstore import FlowWriter, export_csv, save_flows
+from stress import synthetic_filename
+
+nweeks = 52     # weeks per year of the generated flows
+scenario_shifts = {'stat': 0.0, 'dyn': 0.2}    # shift of the mean log flow
+
+
+def fixture_sites(nsites):
+    '''Site names of a fixture with nsites sites'''
+    return all_sites[:nsites] + ['fixtureSite%02dInflow' % j for j in range(len(all_sites), nsites)]
+
+
+def fixture_flows(rng, nchains, nyears, nsites, shift=0.0, site_corr=0.6, week_corr=0.5):
+    '''nchains x nyears x 52 x nsites weekly flows: exp of a seasonal mean plus
+    an AR(1) process across the weeks of each chain, whose innovations are
+    equicorrelated across sites'''
+    C = np.full((nsites, nsites), site_corr) + (1 - site_corr)*np.eye(nsites)
+    L = np.linalg.cholesky(C)
+    E = rng.standard_normal((nyears*nweeks, nchains, nsites)) @ L.T
+    Z = np.empty_like(E)
+    Z[0] = E[0]
+    scale = np.sqrt(1 - week_corr**2)
+    # one step per week, vectorized over the chains
+    for t in range(1, len(E)):
+        Z[t] = week_corr*Z[t-1] + scale*E[t]
+    Z = np.moveaxis(np.reshape(Z, (nyears, nweeks, nchains, nsites)), 2, 0)
+    weeks = np.arange(nweeks)
+    season = 1.0*np.cos(2*np.pi*(weeks - 6) / nweeks)     # wet winter, dry late summer
+    level = np.linspace(3.0, 6.0, nsites)       # sites of different sizes
+    sigma = 0.8 + 0.2*np.cos(2*np.pi*weeks / nweeks)
+    logQ = level + shift + season[:, None] + sigma[:, None]*Z
+    return np.exp(logQ)
+
+
+def _save(path, Q, sites, csv):
+    save_flows(path, Q, sites=sites)
+    if csv:
+        export_csv(path)
+
+
+def _write_synthetic(rng, syn_datadir, sites, num_realizations, nyears, shift, csv, chunk_realizations):
+    '''Writes the SYNxx file of each site, filled chunk_realizations at a time'''
+    paths = [synthetic_filename(syn_datadir, site, nyears) for site in sites]
+    writers = [FlowWriter(path, (num_realizations, nyears*nweeks), sites=site) for path, site in zip(paths, sites)]
+    for a in range(0, num_realizations, chunk_realizations):
+        nchains = min(chunk_realizations, num_realizations - a)
+        S = fixture_flows(rng, nchains, nyears, len(sites), shift)
+        S = np.reshape(S, (nchains, nyears*nweeks, len(sites)))
+        for j, writer in enumerate(writers):
+            writer.write(S[:, :, j])
+    for writer in writers:
+        writer.close()
+    if csv:
+        for path in paths:
+            export_csv(path)
+
+
+def write_fixtures(root, nsites=10, num_realizations=1000, nhist_years=81, num_syn_years=(60, 1),
+                   scenarios=('stat', 'dyn'), seed=0, csv=False, chunk_realizations=200):
+    '''Writes a fixture dataset under root and returns its description, which
+    is also saved as <root>/fixture.json'''
+    sites = fixture_sites(nsites)
+    ss = np.random.SeedSequence(seed)
+    hist_seed, *syn_seeds = ss.spawn(1 + len(scenarios)*len(num_syn_years))
+
+    hist_datadir = root + '/historical-data'
+    os.makedirs(hist_datadir, exist_ok=True)
+    H = fixture_flows(np.random.default_rng(hist_seed), 1, nhist_years, nsites)[0]
+    for j, site in enumerate(sites):
+        _save(hist_datadir + '/' + site + '.csv', H[:, :, j], site, csv)
+    Qdaily_hist, shape = ingest_historical(hist_datadir, sites)
+    _save(hist_datadir + '/Qdaily-hist.csv', Qdaily_hist, sites, csv)
+
+    k = 0
+    for scenario in scenarios:
+        syn_datadir = root + '/synthetic-data-' + scenario
+        os.makedirs(syn_datadir, exist_ok=True)
+        for nyears in num_syn_years:
+            rng = np.random.default_rng(syn_seeds[k])
+            k = k + 1
+            _write_synthetic(rng, syn_datadir, sites, num_realizations, nyears, scenario_shifts[scenario], csv,
+                             chunk_realizations)
+        if 1 in num_syn_years:
+            Qdaily_syn, shape = ingest_synthetic(syn_datadir, 1, sites)
+            _save(syn_datadir + '/Qdaily-syn-' + scenario + '.csv', Qdaily_syn, sites, csv)
+
+    description = {'nsites': nsites, 'num_realizations': num_realizations, 'nhist_years': nhist_years,
+                   'num_syn_years': list(num_syn_years), 'scenarios': list(scenarios), 'seed': seed,
+                   'csv': csv, 'chunk_realizations': chunk_realizations, 'sites': sites}
+    with open(root + '/fixture.json', 'w') as f:
+        json.dump(description, f, indent=1)
+    return description
+
+
+def read_fixture(root):
+    '''The description of the fixture under root, or None if there is none'''
+    path = root + '/fixture.json'
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if a != '--csv']
+    csv = '--csv' in sys.argv[1:]    # also write CSV copies, e.g. to time the CSV fallback
+    root = args[0] if args else 'fixture-data'
+    sizes = [int(a) for a in args[1:4]]
+    nsites, num_realizations, nhist_years = sizes + [10, 1000, 81][len(sizes):]
+    write_fixtures(root, nsites, num_realizations, nhist_years, csv=csv)
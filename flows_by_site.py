@@ -1,48 +1,106 @@
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from flowstore import export_csv, flow_shape, load_flows, save_flows
+from instrument import attach, current, instrumented, stage
+from stress_parallel import read_manifest, shard_filename
+from stress import synthetic_filename
 
 '''
 Reshape each historical and one-year synthetic inflow record into a 1D vector
 Concatenate all vectors into a n x 10 matrix (one column for each site)
 Output the Qdaily matrix for historical and synthetic flows for FDC validation.
 
+Column j of each Qdaily matrix holds all_sites[j]. The site files are loaded
+concurrently on a thread pool and each one is copied straight into its column
+of the preallocated matrix; the numbers of weeks, sites, years and
+realizations are inferred from the files.
+
 '''
 
-hist_datadir = "historical-data"
-syn_datadir = "synthetic-data-stat"     # modify depending on stationary or dynamic dataset
-
-# modify based on test case
-nweeks = 52
-nsites = 10
-nhist_years = 81
-nsyn_real = 1000
-
-Qdaily_hist = np.zeros((nhist_years*nweeks, nsites), dtype=float)
-Qdaily_syn = np.zeros((nsyn_real*nweeks, nsites), dtype=float)
-
-# load the historical and synthetic data
-# Thanks to https://stackoverflow.com/questions/33503993/read-in-all-csv-files-from-a-directory-using-python
-hist_count = 0
-for filename in os.listdir(hist_datadir):
-    if filename.endswith("Inflow.csv"):
-        filepath = hist_datadir + '/' + filename
-        q_file = np.loadtxt(filepath, delimiter=',')
-        q_file2 = np.reshape(q_file, (q_file.shape[0]*q_file.shape[1],))
-        Qdaily_hist[:, hist_count] = q_file2
-        hist_count = hist_count + 1
-        print("hist_count = ", hist_count)
-
-syn_count = 0
-for filename in os.listdir(syn_datadir): 
-    if filename.endswith("_SYN01.csv"):
-        filepath = syn_datadir + '/' + filename
-        q_file = np.loadtxt(filepath, delimiter=',')
-        q_file2 = np.reshape(q_file, (q_file.shape[0]*q_file.shape[1],))
-        Qdaily_syn[:, syn_count] = q_file2
-        syn_count = syn_count + 1
-        print("syn_count = ", syn_count)
-
-hist_datapath = hist_datadir + "/Qdaily-hist.csv"  # modify depending on stationary or dynamic dataset
-syn_datapath = syn_datadir + "/Qdaily-syn-stat.csv"     # modify depending on stationary or dynamic dataset
-np.savetxt(hist_datapath, Qdaily_hist, delimiter=',')
-np.savetxt(syn_datapath, Qdaily_syn, delimiter=',')
+all_sites = ['trainingLittleRiverRaleighInflow','trainingOWASAInflow','trainingClaytonGageInflow',
+             'trainingCrabtreeCreekInflow','trainingFallsLakeInflow','trainingJordanLakeInflow',
+             'trainingLakeWBInflow','trainingLillingtonInflow','trainingLittleRiverInflow','trainingMichieInflow']
+
+
+def _copy_into(Qdaily, path, column, offset, shape, parent=None):
+    '''Copies the flow matrix at path into rows offset: of one column of Qdaily.
+    parent is the instrument.py stage of the thread that submitted the copy.'''
+    with attach(parent):
+        q_file = load_flows(path)
+        if q_file.shape != shape:
+            raise ValueError(path + ' has shape ' + str(q_file.shape) + ', expected ' + str(shape))
+        # a memory-mapped file is read here
+        with stage('reshape', file=os.path.basename(path)):
+            q_file2 = np.reshape(q_file, (q_file.shape[0]*q_file.shape[1],))
+            Qdaily[offset:offset + q_file2.size, column] = q_file2
+
+
+def ingest(tasks, nrows, nsites, max_workers=None):
+    '''Fills a preallocated nrows x nsites matrix from flow files on a thread pool.
+
+    @param tasks A list of (path, column, row offset, expected shape) tuples
+    '''
+    # column-major so that each file is written into contiguous memory
+    Qdaily = np.empty((nrows, nsites), dtype=float, order='F')
+    parent = current()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_copy_into, Qdaily, *task, parent=parent) for task in tasks]
+        for future in futures:
+            future.result()
+    return Qdaily
+
+
+@instrumented('ingest')
+def ingest_historical(datadir, sites=all_sites, max_workers=None):
+    '''Loads the historical record of each site into one column.
+
+    Returns the nhist_years*nweeks x nsites matrix and (nhist_years, nweeks).'''
+    paths = [datadir + '/' + site + '.csv' for site in sites]
+    shape = flow_shape(paths[0])
+    tasks = [(path, j, 0, shape) for j, path in enumerate(paths)]
+    return ingest(tasks, shape[0]*shape[1], len(sites), max_workers), shape
+
+
+@instrumented('ingest')
+def ingest_synthetic(datadir, num_syn_years=1, sites=all_sites, max_workers=None):
+    '''Loads the SYNxx realizations of each site into one column, reading the
+    shards listed in the stress_parallel.py manifest when there is one.
+
+    Returns the nsyn_real*num_syn_years*nweeks x nsites matrix and
+    (nsyn_real, num_syn_years*nweeks).'''
+    manifest = read_manifest(datadir, num_syn_years)
+    if manifest is None:
+        paths = [synthetic_filename(datadir, site, num_syn_years) for site in sites]
+        shape = flow_shape(paths[0])
+        tasks = [(path, j, 0, shape) for j, path in enumerate(paths)]
+    else:
+        shard_path = lambda site, shard: datadir + '/' + shard_filename(site, num_syn_years, shard['block'])
+        # the number of weeks of each realization is read from the first shard
+        ncols = flow_shape(shard_path(sites[0], manifest['shards'][0]))[1]
+        shape = (manifest['num_realizations'], ncols)
+        tasks = []
+        for shard in manifest['shards']:
+            shard_shape = (shard['stop'] - shard['start'], ncols)
+            for j, site in enumerate(sites):
+                tasks.append((shard_path(site, shard), j, shard['start']*ncols, shard_shape))
+    return ingest(tasks, shape[0]*shape[1], len(sites), max_workers), shape
+
+
+if __name__ == '__main__':
+    hist_datadir = "historical-data"
+    syn_datadir = "synthetic-data-stat"     # modify depending on stationary or dynamic dataset
+    write_csv = False    # also write the Qdaily matrices as CSV files
+
+    Qdaily_hist, (nhist_years, nweeks) = ingest_historical(hist_datadir)
+    Qdaily_syn, (nsyn_real, nsyn_cols) = ingest_synthetic(syn_datadir, 1)
+    nsites = len(all_sites)
+    print("nsites = ", nsites, ", nhist_years = ", nhist_years, ", nsyn_real = ", nsyn_real)
+
+    hist_datapath = hist_datadir + "/Qdaily-hist.csv"  # modify depending on stationary or dynamic dataset
+    syn_datapath = syn_datadir + "/Qdaily-syn-stat.csv"     # modify depending on stationary or dynamic dataset
+    save_flows(hist_datapath, Qdaily_hist, sites=all_sites)
+    save_flows(syn_datapath, Qdaily_syn, sites=all_sites)
+    if write_csv:
+        export_csv(hist_datapath)
+        export_csv(syn_datapath)
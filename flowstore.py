@@ -0,0 +1,223 @@
+'''Memory-mapped binary storage for the historical, synthetic and Qdaily flow
+matrices.
+
+Each CSV matrix (historical-data/*.csv, <site>_SYNxx.csv, Qdaily-*.csv) can be
+converted once into a .npy file next to it, with a small JSON header
+(<name>.json) recording the site name(s), dtype and shape, and the size and
+modification time of the CSV file the binary copy stands for. load_flows()
+maps the .npy file into memory without parsing or copying it and falls back
+to the CSV file when there is no binary copy or the CSV file has changed
+since it was converted. A binary copy written directly by save_flows() has
+no CSV source, and any CSV file next to it is stale unless export_csv()
+wrote it.
+
+Running this file converts every CSV file in the data directories:
+
+    python flowstore.py [--float32] [datadir ...]
+'''
+
+import json
+import os
+import sys
+import numpy as np
+
+from instrument import add_bytes, stage
+
+data_dirs = ['historical-data', 'synthetic-data-stat', 'synthetic-data-dyn']
+
+
+def _base(path):
+    '''Strips the .csv/.npy/.json extension from path'''
+    root, ext = os.path.splitext(path)
+    return root if ext in ('.csv', '.npy', '.json') else path
+
+
+def binary_path(path):
+    '''Path of the .npy copy of a flow matrix'''
+    return _base(path) + '.npy'
+
+
+def header_path(path):
+    '''Path of the JSON header of a flow matrix'''
+    return _base(path) + '.json'
+
+
+def csv_path(path):
+    '''Path of the CSV copy of a flow matrix'''
+    return _base(path) + '.csv'
+
+
+def _stamp(path):
+    '''Size and modification time of a file, or None if it does not exist'''
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def has_binary(path):
+    '''True if path has a binary copy that is up to date with its CSV file'''
+    npy = binary_path(path)
+    if not os.path.exists(npy):
+        return False
+    csv = csv_path(path)
+    if not os.path.exists(csv):
+        return True
+    header = read_header(path)
+    if header is not None and 'source' in header:
+        # a binary copy without a CSV source supersedes any CSV file
+        return header['source'] is None or header['source'] == _stamp(csv)
+    # headers written before the CSV stamp was recorded
+    return os.path.getmtime(csv) <= os.path.getmtime(npy)
+
+
+def source_path(path):
+    '''The file load_flows() reads a flow matrix from'''
+    return binary_path(path) if has_binary(path) else csv_path(path)
+
+
+def save_flows(path, Q, sites=None, dtype=None):
+    '''Writes Q as a .npy file with a JSON header.
+
+    @param path The .csv, .npy or extension-less path of the flow matrix
+    @param sites The site name(s) of the columns (Qdaily) or of the whole matrix (historical/SYNxx)
+    @param dtype The stored dtype, e.g. np.float32 to halve the file size; defaults to Q's dtype
+
+    A CSV file already next to path is left as it is but no longer read;
+    export_csv() rewrites it from the binary copy.
+    '''
+    _write_binary(path, Q, sites, dtype, None)
+
+
+def _write_binary(path, Q, sites, dtype, source):
+    '''save_flows(), recording source, the _stamp() of the CSV file Q was read from'''
+    Q = np.asarray(Q) if dtype is None else np.asarray(Q, dtype=dtype)
+    np.save(binary_path(path), Q)
+    if isinstance(sites, str):
+        sites = [sites]
+    header = {'sites': None if sites is None else list(sites), 'dtype': Q.dtype.str,
+              'shape': list(Q.shape), 'source': source}
+    _write_header(path, header)
+
+
+class FlowWriter(object):
+    '''Writes a binary flow matrix of a known shape one block of rows at a
+    time, so that it never has to be held in memory. Like save_flows(), the
+    result has no CSV source.'''
+
+    def __init__(self, path, shape, sites=None, dtype=float):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.nrows = 0
+        self._file = open(binary_path(path), 'wb')
+        np.lib.format.write_array_header_1_0(self._file, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                          'fortran_order': False, 'shape': self.shape})
+        if isinstance(sites, str):
+            sites = [sites]
+        self.sites = None if sites is None else list(sites)
+
+    def write(self, rows):
+        '''Appends the next rows (nrows x the remaining dimensions)'''
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.shape[1:] or self.nrows + rows.shape[0] > self.shape[0]:
+            raise ValueError('Rows of shape ' + str(rows.shape) + ' do not fit in ' + str(self.shape))
+        self._file.write(rows.tobytes())
+        self.nrows = self.nrows + rows.shape[0]
+
+    def close(self):
+        '''Closes the file and writes its header once every row is written'''
+        self._file.close()
+        if self.nrows != self.shape[0]:
+            raise ValueError(self.path + ' has ' + str(self.nrows) + ' of ' + str(self.shape[0]) + ' rows')
+        _write_header(self.path, {'sites': self.sites, 'dtype': self.dtype.str, 'shape': list(self.shape),
+                                  'source': None})
+
+
+def _write_header(path, header):
+    with open(header_path(path), 'w') as f:
+        json.dump(header, f)
+
+
+def read_header(path):
+    '''Returns the JSON header of a binary flow matrix, or None if it has none'''
+    hdr = header_path(path)
+    if not os.path.exists(hdr):
+        return None
+    with open(hdr) as f:
+        return json.load(f)
+
+
+def load_flows(path, mmap_mode='c'):
+    '''Loads a flow matrix, memory-mapping its binary copy when there is an
+    up-to-date one and parsing the CSV file otherwise.
+
+    The default copy-on-write mapping reads the file without copying it while
+    still allowing callers to modify the array in memory.
+
+    @param path The .csv, .npy or extension-less path of the flow matrix
+    @param mmap_mode The np.load memory-map mode, or None to read the whole file
+    '''
+    with stage('load', file=os.path.basename(_base(path))):
+        if has_binary(path):
+            Q = np.load(binary_path(path), mmap_mode=mmap_mode)
+        else:
+            Q = np.loadtxt(csv_path(path), delimiter=',', ndmin=2)
+        # a memory map is only read later, when its pages are touched
+        add_bytes(Q.nbytes)
+        return Q
+
+
+def flow_shape(path):
+    '''Returns the shape of a flow matrix without loading it'''
+    if has_binary(path):
+        return np.load(binary_path(path), mmap_mode='r').shape
+    nrows = 0
+    ncols = 0
+    with open(csv_path(path)) as f:
+        for line in f:
+            if line.strip():
+                if nrows == 0:
+                    ncols = len(line.split(','))
+                nrows = nrows + 1
+    return (nrows, ncols)
+
+
+def convert_csv(path, sites=None, dtype=None):
+    '''Converts the CSV file of a flow matrix into its binary copy'''
+    # stamped before reading, so that a CSV file changed meanwhile is not taken as converted
+    source = _stamp(csv_path(path))
+    Q = np.loadtxt(csv_path(path), delimiter=',', ndmin=2)
+    name = os.path.basename(_base(path))
+    if sites is None and not name.startswith('Qdaily'):
+        # historical and SYNxx files hold a single site; the column order of
+        # a Qdaily file is only known to flows_by_site.py
+        sites = [name.split('_SYN')[0]]
+    _write_binary(path, Q, sites, dtype, source)
+
+
+def export_csv(path):
+    '''Writes the binary copy of a flow matrix back out as CSV, and records
+    the CSV file in its header so that the binary copy is still used'''
+    Q = np.load(binary_path(path), mmap_mode='r')
+    np.savetxt(csv_path(path), Q, delimiter=',')
+    header = read_header(path) or {'sites': None, 'dtype': Q.dtype.str, 'shape': list(Q.shape)}
+    header['source'] = _stamp(csv_path(path))
+    _write_header(path, header)
+
+
+def convert_directory(datadir, dtype=None):
+    '''Converts every CSV file in datadir that has no up-to-date binary copy'''
+    for filename in sorted(os.listdir(datadir)):
+        path = datadir + '/' + filename
+        if filename.endswith('.csv') and not has_binary(path):
+            convert_csv(path, dtype=dtype)
+            print('converted ' + path)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    dtype = np.float32 if '--float32' in args else None
+    dirs = [a for a in args if a != '--float32'] or [d for d in data_dirs if os.path.isdir(d)]
+    for datadir in dirs:
+        convert_directory(datadir, dtype=dtype)
@@ -0,0 +1,371 @@
+'''Stage-level timing and memory instrumentation of the pipeline.
+
+Pipeline stages (file loads, reshapes, FDC sorting, statistical tests,
+bootstrap, plotting, savefig, ...) are wrapped in stage() blocks or
+@instrumented functions. While instrumentation is disabled these cost one
+global lookup; once enable() is called every stage records its wall time,
+CPU time, bytes read, the bytes of the arrays it loaded (add_bytes()), the
+change and peak of the resident memory of the process during the stage and,
+with trace_memory, the peak of the memory allocated during the stage
+(tracemalloc, which slows the run down). Stages nest and inherit the labels
+of the stages around them, so a load inside stage('site', site=...) is
+attributed to that site; worker threads attach() to the stage that started
+them.
+
+Bytes read only counts read() calls. Memory-mapped files are read when
+their pages are first touched, by whichever stage does so, so loads also
+record the size of the arrays they map or parse as bytes_loaded. The peak
+resident memory of a stage is measured by resetting the high-water mark of
+the process (Linux only), so the process-wide peak is tracked here instead.
+
+Records are kept in memory, optionally printed as a live progress log as
+each stage ends, and written as a JSON report with totals per stage and per
+site. Setting the environment variables
+
+    STRESS_REPORT=report.json   write the report when the process exits
+    STRESS_PROGRESS=1           print the progress log to stderr
+    STRESS_TRACE_MEMORY=1       trace the peak allocated memory of each stage
+
+turns instrumentation on for any script without changing it. CPU time and
+bytes read are process-wide, so stages running on several threads at once
+share them.
+'''
+
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+_recorder = None
+
+
+class _NullStage(object):
+    '''The stage returned while instrumentation is disabled'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def _bytes_read():
+    '''Bytes read by the process so far, from /proc/self/io (Linux only)'''
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _max_rss_mb():
+    '''High-water mark of the resident memory of the process'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _rss_mb():
+    '''Current and high-water resident memory of the process since the last
+    _reset_peak_rss(), from /proc/self/status (Linux only)'''
+    rss = hwm = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 2**10
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return rss, hwm
+
+
+def _reset_peak_rss():
+    '''Resets the high-water mark of the resident memory; False if it cannot'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Recorder(object):
+    '''Collects the records of the stages run while it is enabled'''
+
+    def __init__(self, log=None, trace_memory=False):
+        self.log = log
+        self.trace_memory = trace_memory
+        self.records = []
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # resetting the high-water mark also lowers ru_maxrss, so the peak
+        # resident memory of the process is kept here
+        self.peak_rss = _max_rss_mb()
+        self.reset_rss = _rss_mb()[1] is not None and _reset_peak_rss()
+
+    def stack(self):
+        '''The stages open in the current thread'''
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def fold_peak(self):
+        '''Credits the traced and resident peaks since the last call to every
+        open stage. Returns the current resident memory.'''
+        rss, hwm = _rss_mb()
+        if self.reset_rss:
+            with self._lock:
+                self.peak_rss = max(self.peak_rss or 0.0, hwm)
+                _reset_peak_rss()
+            for frame in self.stack():
+                frame.peak_rss = max(frame.peak_rss, hwm)
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for frame in self.stack():
+                frame.peak = max(frame.peak, peak)
+            tracemalloc.reset_peak()
+        return rss
+
+    def max_rss_mb(self):
+        '''Peak resident memory of the process'''
+        if self.reset_rss:
+            self.fold_peak()
+            return self.peak_rss
+        return _max_rss_mb()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+        if self.log is not None:
+            labels = ' '.join('%s=%s' % item for item in sorted(record['labels'].items()))
+            self.log.write('[%8.2fs] %-28s %8.3fs wall %8.3fs cpu %9s read %9s loaded %9s rss %s\n' % (
+                record['start_s'] + record['wall_s'], record['path'], record['wall_s'], record['cpu_s'],
+                '-' if record['bytes_read'] is None else '%.1fMB' % (record['bytes_read'] / 2**20),
+                '%.1fMB' % (record['bytes_loaded'] / 2**20),
+                '-' if record['rss_delta_mb'] is None else '%+.1fMB' % record['rss_delta_mb'], labels))
+            self.log.flush()
+
+
+class _Stage(object):
+    '''A running stage of an enabled Recorder'''
+
+    def __init__(self, recorder, name, labels):
+        self.recorder = recorder
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        r = self.recorder
+        stack = r.stack()
+        if stack:
+            self.labels = dict(stack[-1].labels, **self.labels)
+            self.path = stack[-1].path + '/' + self.name
+        else:
+            self.path = self.name
+        self.rss0 = r.fold_peak()
+        self.peak_rss = self.rss0 or 0.0
+        self.mem0 = tracemalloc.get_traced_memory()[0] if r.trace_memory else 0
+        self.peak = self.mem0
+        self.bytes_loaded = 0
+        stack.append(self)
+        self.io0 = _bytes_read()
+        self.cpu0 = time.process_time()
+        self.wall0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall0
+        cpu = time.process_time() - self.cpu0
+        io = _bytes_read()
+        r = self.recorder
+        rss = r.fold_peak()
+        r.stack().pop()
+        r.add({'name': self.name, 'path': self.path, 'labels': self.labels,
+               'start_s': self.wall0 - r.t0, 'wall_s': wall, 'cpu_s': cpu,
+               'bytes_read': None if io is None or self.io0 is None else io - self.io0,
+               'bytes_loaded': self.bytes_loaded,
+               'peak_mb': (self.peak - self.mem0) / 2**20 if r.trace_memory else None,
+               'rss_delta_mb': None if rss is None or self.rss0 is None else rss - self.rss0,
+               'peak_rss_mb': self.peak_rss if r.reset_rss else None,
+               'max_rss_mb': r.peak_rss if r.reset_rss else _max_rss_mb(), 'pid': os.getpid(),
+               'error': None if exc_type is None else exc_type.__name__})
+        return False
+
+
+class _Attach(object):
+    '''Opens a stage of another thread in the current one, without recording it again'''
+
+    def __init__(self, recorder, parent):
+        self.recorder = recorder
+        self.parent = parent
+
+    def __enter__(self):
+        self.recorder.stack().append(self.parent)
+        return self.parent
+
+    def __exit__(self, *exc):
+        self.recorder.stack().pop()
+        return False
+
+
+def stage(name, **labels):
+    '''Context manager recording one stage, labelled e.g. with site=...'''
+    if _recorder is None:
+        return _null_stage
+    return _Stage(_recorder, name, labels)
+
+
+def instrumented(name):
+    '''Decorator recording every call of a function as a stage'''
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return f(*args, **kwargs)
+            with _Stage(_recorder, name, {}):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def current():
+    '''The innermost stage open in this thread, or None; pass it to attach()
+    in the threads the stage starts'''
+    if _recorder is None:
+        return None
+    stack = _recorder.stack()
+    return stack[-1] if stack else None
+
+
+def attach(parent):
+    '''Context manager nesting the stages of a worker thread in parent, the
+    current() stage of the thread that started it'''
+    if _recorder is None or parent is None or parent.recorder is not _recorder:
+        return _null_stage
+    return _Attach(_recorder, parent)
+
+
+def add_bytes(nbytes):
+    '''Adds nbytes loaded, e.g. the size of a memory-mapped array, to the open stages'''
+    if _recorder is None:
+        return
+    with _recorder._lock:
+        for frame in _recorder.stack():
+            frame.bytes_loaded += nbytes
+
+
+def enabled():
+    return _recorder is not None
+
+
+def enable(report_path=None, log=False, trace_memory=False):
+    '''Starts recording stages; the report is written to report_path at exit if given.
+
+    @param log True to print the progress log to stderr, or a file to print it to
+    '''
+    global _recorder
+    _recorder = Recorder(sys.stderr if log is True else (log or None), trace_memory)
+    # worker processes send their records to the parent instead
+    if report_path and multiprocessing.parent_process() is None:
+        atexit.register(write_report, report_path)
+    return _recorder
+
+
+def disable():
+    '''Stops recording and returns the report of the recorded stages'''
+    global _recorder
+    result = report()
+    if _recorder is not None and _recorder.trace_memory:
+        tracemalloc.stop()
+    _recorder = None
+    return result
+
+
+def drain():
+    '''Returns and forgets the records so far, e.g. to send them from a worker process'''
+    if _recorder is None:
+        return []
+    with _recorder._lock:
+        records, _recorder.records = _recorder.records, []
+    return records
+
+
+def merge(records):
+    '''Adds the records of another process'''
+    if _recorder is not None:
+        with _recorder._lock:
+            _recorder.records.extend(records)
+
+
+def _totals(records):
+    totals = {}
+    for rec in records:
+        t = totals.setdefault(rec['name'], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'bytes_read': 0,
+                                            'bytes_loaded': 0, 'rss_delta_mb': 0.0, 'peak_mb': None,
+                                            'peak_rss_mb': None, 'max_rss_mb': None})
+        t['count'] += 1
+        for key in ('wall_s', 'cpu_s', 'bytes_read', 'bytes_loaded', 'rss_delta_mb'):
+            t[key] += rec.get(key) or 0
+        for key in ('peak_mb', 'peak_rss_mb', 'max_rss_mb'):
+            if rec.get(key) is not None:
+                t[key] = rec[key] if t[key] is None else max(t[key], rec[key])
+    return totals
+
+
+def report():
+    '''The recorded stages with their totals per stage name and per site.
+    Totals add up nested stages separately, so a parent includes its children.'''
+    if _recorder is None:
+        return None
+    with _recorder._lock:
+        records = list(_recorder.records)
+    max_rss_mb = _recorder.max_rss_mb()
+    sites = {}
+    for rec in records:
+        if 'site' in rec['labels']:
+            sites.setdefault(rec['labels']['site'], []).append(rec)
+    return {'argv': sys.argv, 'pid': os.getpid(), 'wall_s': time.perf_counter() - _recorder.t0,
+            'max_rss_mb': max_rss_mb, 'trace_memory': _recorder.trace_memory,
+            'stages': _totals(records),
+            'sites': dict((site, _totals(recs)) for site, recs in sites.items()),
+            'records': records}
+
+
+def write_report(path):
+    '''Writes report() as JSON'''
+    result = report()
+    if result is None:
+        return None
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=1)
+    return result
+
+
+if os.environ.get('STRESS_REPORT') or os.environ.get('STRESS_PROGRESS'):
+    enable(os.environ.get('STRESS_REPORT'), log=bool(os.environ.get('STRESS_PROGRESS')),
+           trace_memory=bool(os.environ.get('STRESS_TRACE_MEMORY')))
@@ -1,11 +1,11 @@
 from __future__ import division
 import numpy as np 
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas as pd 
-import seaborn as sns
-from scipy import stats
 import os
+from artifacts import artifact_path, load_artifact
+from boxstats import bxp_stats
+from compute import convergence_name
+from convergence import write_convergence_artifact
+from instrument import instrumented, stage
 
 '''
 Plots boxplots characterizing the internal variability as a function of the number of realization in
@@ -15,7 +15,11 @@ a synthetic inflow of site s.
 3) Obtain the mean and std deviation of the means and std deviations across m-realizations
 4) Repeat for increasing numbers of realizations (100,200,...1000)
 
-Site to be printed can be changed on line 171.
+Site to be printed can be changed on line 158.
+
+The statistics are computed by convergence.py and stored as an artifact (see
+compute.py); this file only renders them. matplotlib and seaborn are imported
+when plotting, so the module can be imported by compute-only code.
 '''
 
 all_sites = ['trainingLittleRiverRaleighInflow','trainingOWASAInflow','trainingClaytonGageInflow',
@@ -33,11 +37,11 @@ def assure_path_exists(path):
     dir = os.path.dirname(path)
     if not os.path.exists(dir):
         os.makedirs(dir)
-                
-assure_path_exists(os.getcwd() + '/figures/')
 
 def init_plotting():
     '''Sets plotting characteristics'''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     sns.set_style('whitegrid')
     plt.rcParams['figure.figsize'] = (12, 12)
     plt.rcParams['font.size'] = 15
@@ -50,6 +54,7 @@ def init_plotting():
 
 def set_box_color(bp, color):
     '''Sets colors of boxplot elements'''
+    import matplotlib.pyplot as plt
     plt.setp(bp['boxes'], color=color)
     plt.setp(bp['whiskers'], color=color, linestyle='solid')
     plt.setp(bp['caps'], color=color)
@@ -66,51 +71,31 @@ increasing realizations.
 
 '''
 
-def internal_variability(s, space, quantile=1.0, drought=True):
-    assure_path_exists(os.getcwd() + '/figures/')
+def internal_variability(s, space, quantile=1.0, drought=True, scenario='stat'):
     site = all_sites[s]
-    sitename = all_sitenames[s]
+    path = artifact_path(convergence_name(site, space, quantile, drought, scenario))
+    write_convergence_artifact(path, site, 'synthetic-data-' + scenario, 60, space, quantile, drought)
+    render_internal_variability(path, all_sitenames[s], space, drought,
+                                'figures/internal-variability-' + space + '-' + scenario + '.pdf')
+
+'''
+Renders an internal variability artifact written by convergence.write_convergence_artifact.
+'''
+
+@instrumented('plot')
+def render_internal_variability(path, sitename, space, drought, fig_name):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    assure_path_exists(os.getcwd() + '/figures/')
+    result, meta = load_artifact(path)
+    idx = result['n']   # realization indices
+    S25_means = result['mean_of_means']
+    S25_std = result['std_of_stds']
 
-    S = np.loadtxt('synthetic-data-stat/' + site + '_SYN60.csv', delimiter=',') # modify depending on stationary or dynamic dataset
-    S = S.reshape((np.shape(S)[0], int(np.shape(S)[1]/52),52)) # n_realizations x n_syn_years x 52
-    
-    # sort all years in each realization by increasing/decreasing inflows
-    if space == 'log':
-        S = np.log(S)
-    for i in range(S.shape[0]):     # for i in range 1000
-        S_i = S[i,:,:]
-        for j in range(S_i.shape[0]):    # for j in range n_syn_years
-            S_ij = S_i[j,:]
-            # if drought, sort in order of increasing flows
-            # # else if flood, sort in order of decreasing flows
-            if (drought == True):
-                S_ij = np.sort(S_ij)
-            else:
-                S_ij = np.sort(S_ij)[::-1]
-            S_i[j,:] = S_ij
-        S[i,:,:] = S_i
-
-    S25 = S[:, :,:int(S.shape[2]*quantile)]
-    idx = np.arange(50, 1050, 50)   # realization indices
-    S25plot = np.zeros((len(idx), S25.shape[1], S25.shape[2]), dtype=float)
-    for m in range(len(idx)):
-        S25plot[m,:,:] = S25[idx[m]-1,:,:]
-    S25plot = np.reshape(S25plot, (S25plot.shape[1]*S25plot.shape[2], S25plot.shape[0]))
-    S25 = np.reshape(S25, (S25.shape[1]*S25.shape[2], S25.shape[0]))
-    means_per_real = np.mean(S25, axis=0)
-    std_per_real = np.std(S25, axis=0)
-    S25_means = np.zeros(len(idx))
-    S25_std = np.zeros(len(idx))
-
-    for k in range(len(idx)):
-        over = idx[k]
-        S25_means[k] = np.mean(means_per_real[:over-1])
-        S25_std[k] = np.std(std_per_real[:over-1])
-    
     # make the plots
     fig = plt.figure()
     ax = fig.add_subplot(3,1,1)    # box plots
-    bpl_syn = plt.boxplot(S25plot, sym='', widths=0.3, patch_artist=True, meanline=True)
+    bpl_syn = ax.bxp(bxp_stats(result['box']), widths=0.3, patch_artist=True, showfliers=False)
     set_box_color(bpl_syn, 'lightskyblue')
     plt.plot([], c='lightskyblue')      
     
@@ -165,8 +150,9 @@ def internal_variability(s, space, quantile=1.0, drought=True):
     #fig.tight_layout()
     fig.subplots_adjust(top=0.9,wspace=0.1, hspace=0.5)
     
-    fig_name = 'figures/internal-variability-' + space + '-stat.pdf'     # modify depending on stationary or dynamic dataset
-    fig.savefig(fig_name)
-    fig.clf()
+    with stage('savefig', figure=fig_name):
+        fig.savefig(fig_name)
+    plt.close(fig)
 
-internal_variability(5, 'log', quantile=1.0, drought=False)
\ No newline at end of file
+if __name__ == '__main__':
+    internal_variability(5, 'log', quantile=1.0, drought=False, scenario='stat')     # modify depending on stationary or dynamic dataset
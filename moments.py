@@ -0,0 +1,234 @@
+'''Batched statistical validation of weekly historical and synthetic flows.
+
+weekly-moments.py tests each week of one site with scipy.stats.ranksums and
+scipy.stats.levene. The functions below compute the same p-values for every
+week (and every site) at once: ranks are taken along one axis of the pooled
+historical and synthetic samples and the Levene statistic is built from
+batched group medians and absolute deviations. Only the final normal and F
+tail probabilities come from scipy.special, which is imported when needed.
+
+bootstrap_moments() resamples the weekly moments of the historical record
+from multinomial resample counts instead of materializing the resamples.
+
+For very large ensembles the box statistics of the weekly synthetic flows
+can be taken from a boxstats.QuantileSketch, built chunk by chunk or, with
+weekly_sketch(), one shard per process and merged.
+
+Arrays are laid out as (..., nobs, nweeks): the historical record H is
+nhist_years x 52 and the synthetic record S is (n_realizations*n_syn_years)
+x 52 for one site, with optional leading site axes.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from artifacts import save_artifact
+from boxstats import QuantileSketch, box_stats
+from ensemble import SyntheticEnsemble
+from flows_by_site import all_sites
+from flowstore import load_flows, source_path
+from instrument import instrumented
+from statcache import StatCache
+from stress_parallel import synthetic_sources
+
+nweeks = 52
+
+
+def rankdata(a, axis=-1):
+    '''Ranks of a along axis, starting at 1, with ties given their average rank'''
+    a = np.moveaxis(np.asarray(a), axis, -1)
+    order = np.argsort(a, axis=-1, kind='stable')
+    srt = np.take_along_axis(a, order, axis=-1)
+    n = srt.shape[-1]
+    pos = np.broadcast_to(np.arange(n), srt.shape)
+
+    # first and last position of the tie group of each sorted element
+    new_group = np.ones(srt.shape, dtype=bool)
+    new_group[..., 1:] = srt[..., 1:] != srt[..., :-1]
+    first = np.maximum.accumulate(np.where(new_group, pos, 0), axis=-1)
+    end_group = np.ones(srt.shape, dtype=bool)
+    end_group[..., :-1] = new_group[..., 1:]
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(end_group, pos, n - 1), -1), axis=-1), -1)
+
+    ranks = np.empty(srt.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=-1)
+    return np.moveaxis(ranks, -1, axis)
+
+
+@instrumented('tests')
+def ranksums_pvalues(H, S):
+    '''Two-sided Wilcoxon rank-sum p-values (as scipy.stats.ranksums) comparing
+    H and S along their observation axis (-2) for every week'''
+    from scipy.special import ndtr
+    n1 = H.shape[-2]
+    n2 = S.shape[-2]
+    ranks = rankdata(np.concatenate((H, S), axis=-2), axis=-2)
+    s = ranks[..., :n1, :].sum(axis=-2)
+    expected = n1*(n1 + n2 + 1) / 2.0
+    z = (s - expected) / np.sqrt(n1*n2*(n1 + n2 + 1) / 12.0)
+    return 2*ndtr(-np.abs(z))
+
+
+@instrumented('tests')
+def levene_pvalues(H, S):
+    '''Levene test p-values (as scipy.stats.levene with center='median') for
+    equal variances of H and S along their observation axis (-2) for every week'''
+    from scipy.special import fdtrc
+    n = np.array([H.shape[-2], S.shape[-2]], dtype=float)
+    N = n.sum()
+    k = 2
+    Z = [np.abs(X - np.median(X, axis=-2, keepdims=True)) for X in (H, S)]
+    Zbar = np.stack([z.mean(axis=-2) for z in Z])
+    Zbar_all = np.tensordot(n, Zbar, axes=1) / N
+    numer = (N - k) * np.tensordot(n, (Zbar - Zbar_all)**2, axes=1)
+    denom = (k - 1) * sum(((z - zb[..., None, :])**2).sum(axis=-2) for z, zb in zip(Z, Zbar))
+    return fdtrc(k - 1, N - k, numer / denom)
+
+
+@instrumented('bootstrap')
+def bootstrap_moments(H, num_resamples, seed=None, chunk_size=1000):
+    '''Bootstrapped weekly means and standard deviations of H (nobs x 52).
+
+    Equivalent to H[r].mean(axis=0) and H[r].std(axis=0) for
+    r = randint(nobs, size=(nobs, num_resamples)), but each resample is
+    represented by how many times it draws each year (a multinomial count
+    vector), and its moments are computed from the count-weighted sums and
+    sums of squares. Resamples are drawn chunk_size at a time, so memory is
+    O(num_resamples x 52) rather than O(nobs x num_resamples x 52).
+
+    Returns two num_resamples x 52 arrays.
+    '''
+    rng = np.random.default_rng(seed)
+    H = np.asarray(H, dtype=float)
+    N = H.shape[0]
+    # centre each week to avoid cancellation in E[x^2] - E[x]^2
+    mu = H.mean(axis=0)
+    Hc = H - mu
+    Hc2 = Hc**2
+    means = np.empty((num_resamples, H.shape[1]))
+    stds = np.empty((num_resamples, H.shape[1]))
+    for start in range(0, num_resamples, chunk_size):
+        stop = min(start + chunk_size, num_resamples)
+        counts = rng.multinomial(N, np.full(N, 1.0/N), size=stop - start)
+        m1 = np.matmul(counts, Hc) / N
+        m2 = np.matmul(counts, Hc2) / N
+        means[start:stop] = m1 + mu
+        stds[start:stop] = np.sqrt(np.maximum(m2 - m1**2, 0))
+    return means, stds
+
+
+def weekly_pvalues(H, S):
+    '''Rank-sum and Levene p-values of every week in real and log space.
+
+    Returns {'real': {'ranksums': ..., 'levene': ...}, 'log': {...}} with
+    arrays shaped like H without its observation axis (e.g. nsites x 52).'''
+    # ranks, and therefore the rank-sum test, are unchanged by the log transform
+    ranksums = ranksums_pvalues(H, S)
+    logH = np.log(H)
+    logS = np.log(S)
+    return {'real': {'ranksums': ranksums, 'levene': levene_pvalues(H, S)},
+            'log': {'ranksums': ranksums, 'levene': levene_pvalues(logH, logS)}}
+
+
+def load_weekly(site, hist_datadir='historical-data', syn_datadir='synthetic-data-stat', num_syn_years=60):
+    '''Returns the nhist_years x 52 historical and n_realizations x
+    n_syn_years x 52 synthetic weekly flows of a site'''
+    H = load_flows(hist_datadir + '/' + site + '.csv')
+    return H, SyntheticEnsemble(syn_datadir, num_syn_years, [site]).site_values(site)
+
+
+def validate_sites(sites=all_sites, hist_datadir='historical-data', syn_datadir='synthetic-data-stat',
+                   num_syn_years=60):
+    '''weekly_pvalues() of every site, as (site x week) tables'''
+    data = [load_weekly(site, hist_datadir, syn_datadir, num_syn_years) for site in sites]
+    H = np.stack([d[0] for d in data])
+    S = np.stack([np.reshape(d[1], (-1, nweeks)) for d in data])
+    return weekly_pvalues(H, S)
+
+
+@instrumented('moments')
+def site_moments(H, S, num_resamples=None, seed=None, relative_accuracy=None, chunk_realizations=1000):
+    '''Statistics plotted by weekly-moments.py for one site in one space.
+
+    @param H The nhist_years x 52 historical record
+    @param S The n_realizations x n_syn_years x 52 synthetic record
+    @param num_resamples The number of bootstrap resamples of H; one per realization by default
+    @param relative_accuracy If given, the box statistics of the weekly synthetic
+                             flows come from a QuantileSketch fed chunk_realizations at a time
+
+    Returns the boxplot statistics (see boxstats.py) of the 'weekly' flows and
+    of the weekly 'mean's and 'std's of the synthetic ('syn') and bootstrapped
+    historical ('hist') records, and the 'ranksums' and 'levene' p-values.'''
+    S_weekly = np.reshape(S, (-1, nweeks))
+    if num_resamples is None:
+        num_resamples = S.shape[0]
+    H_means, H_stds = bootstrap_moments(H, num_resamples, seed)
+    if relative_accuracy is None:
+        weekly = box_stats(S_weekly)
+    else:
+        sketch = QuantileSketch(nweeks, relative_accuracy)
+        for a in range(0, S.shape[0], chunk_realizations):
+            sketch.update(np.reshape(S[a:a + chunk_realizations], (-1, nweeks)))
+        weekly = sketch.box_stats()
+    return {'weekly': {'syn': weekly, 'hist': box_stats(H)},
+            'mean': {'syn': box_stats(S.mean(axis=1)), 'hist': box_stats(H_means)},
+            'std': {'syn': box_stats(S.std(axis=1)), 'hist': box_stats(H_stds)},
+            'ranksums': ranksums_pvalues(H, S_weekly), 'levene': levene_pvalues(H, S_weekly)}
+
+
+def _shard_sketch(args):
+    '''QuantileSketch of the weekly flows of one synthetic file'''
+    path, space, relative_accuracy = args
+    Q = np.reshape(load_flows(path), (-1, nweeks))
+    return QuantileSketch(nweeks, relative_accuracy).update(np.log(Q) if space == 'log' else Q)
+
+
+def weekly_sketch(site, syn_datadir='synthetic-data-stat', num_syn_years=60, space='real', relative_accuracy=0.005,
+                  max_workers=None):
+    '''QuantileSketch of the weekly synthetic flows of a site, built with one
+    sketch per stress_parallel.py shard on a process pool and merged'''
+    paths = [path for path in synthetic_sources(syn_datadir, site, num_syn_years) if not path.endswith('.json')]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        sketches = list(pool.map(_shard_sketch, [(path, space, relative_accuracy) for path in paths]))
+    for sketch in sketches[1:]:
+        sketches[0].merge(sketch)
+    return sketches[0]
+
+
+def cached_moments(site, hist_datadir='historical-data', syn_datadir='synthetic-data-stat', num_syn_years=60,
+                   seed=None, cache=None, data=None, relative_accuracy=None):
+    '''site_moments() of a site in real and log space, read from the
+    statcache.py cache when the input files and parameters are unchanged.
+
+    @param seed The bootstrap seed; results computed with seed=None are reused for later seed=None calls
+    @param cache A statcache.StatCache; the default cache if None
+    @param data A function of the space returning (H, S) in that space, used
+                instead of load_weekly() on a cache miss
+    '''
+    cache = StatCache() if cache is None else cache
+    inputs = [source_path(hist_datadir + '/' + site + '.csv')] + synthetic_sources(syn_datadir, site, num_syn_years)
+    params = {'site': site, 'num_syn_years': num_syn_years, 'seed': seed}
+    if relative_accuracy is not None:
+        params['relative_accuracy'] = relative_accuracy
+
+    def compute():
+        if data is None:
+            H, S = load_weekly(site, hist_datadir, syn_datadir, num_syn_years)
+            get = lambda space: (H, S) if space == 'real' else (np.log(H), np.log(S))
+        else:
+            get = data
+        rng = np.random.default_rng(seed)
+        return dict((space, site_moments(*get(space), seed=rng, relative_accuracy=relative_accuracy))
+                    for space in ('real', 'log'))
+    return cache.cached('moments', inputs, params, compute)
+
+
+def write_moments_artifact(path, site, hist_datadir='historical-data', syn_datadir='synthetic-data-stat',
+                           num_syn_years=60, seed=None, cache=None, relative_accuracy=None):
+    '''Writes site_moments() of a site in real and log space to the artifact
+    read by weekly-moments.py'''
+    result = cached_moments(site, hist_datadir, syn_datadir, num_syn_years, seed, cache,
+                            relative_accuracy=relative_accuracy)
+    save_artifact(path, result, {'site': site, 'hist_datadir': hist_datadir, 'syn_datadir': syn_datadir,
+                                 'num_syn_years': num_syn_years})
+    return result
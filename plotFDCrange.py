@@ -4,12 +4,18 @@ sites.
 
 The list of sites can be changed on line 11 and 15.
 
-The assumption of stationarity can be changed on lines 101, 103 and 106. '''
+The assumption of stationarity can be changed on line 105.
+
+The FDC envelopes are computed by fdc.py and stored as an artifact (see
+compute.py); this file only renders them. matplotlib and seaborn are imported
+when plotting, so the module can be imported by compute-only code. '''
 
 import numpy as np
-from matplotlib import pyplot as plt
-import seaborn as sns
 import os
+from artifacts import artifact_path, load_artifact
+from compute import fdc_name
+from fdc import write_fdc_artifact
+from instrument import instrumented, stage
 
 all_sites = ['trainingLittleRiverRaleighInflow','trainingOWASAInflow','trainingClaytonGageInflow',
              'trainingCrabtreeCreekInflow','trainingFallsLakeInflow','trainingJordanLakeInflow',
@@ -26,11 +32,10 @@ def assure_path_exists(path):
     if not os.path.exists(dir):
         os.makedirs(dir)
 
-# getcwd() returns the current working directory of a process
-assure_path_exists(os.getcwd() + '/figures/')
-
 def init_plotting():
     '''Sets plotting characteristics'''
+    from matplotlib import pyplot as plt
+    import seaborn as sns
     sns.set_style('whitegrid')
     plt.rcParams['figure.figsize'] = (20,12)  # changes made here
     plt.rcParams['font.size'] = 18
@@ -41,47 +46,32 @@ def init_plotting():
     plt.rcParams['xtick.labelsize'] = plt.rcParams['font.size']
     plt.rcParams['ytick.labelsize'] = plt.rcParams['font.size']
 
-init_plotting()
-
 # FDC: flow duration curve
-def plotFDCrange(Qdaily_syn, Qdaily_hist, sites):
+@instrumented('plot')
+def plotFDCrange(env_syn, env_hist, sites, title, fig_name):
+    '''Plots the FDC envelopes returned by fdc.fdc_envelopes'''
+    from matplotlib import pyplot as plt
 
-    n = 52
-    M = np.array(range(1, n+1))
-    P = (M-0.5)/n
+    P = env_hist['P']
 
     fig = plt.figure()
+    nrows = (len(sites) + 4) // 5
     for j in range(len(sites)):
-        # load data for site j
-        histData_j = Qdaily_hist[:, j]
-        synData_j = Qdaily_syn[:, j]
-
-        histData_newshape = (len(histData_j)//n, n)
-        synData_newshape = (len(synData_j)//n, n)
-        q_hist = np.reshape(histData_j, histData_newshape)
-        q_syn = np.reshape(synData_j, synData_newshape)
-
-        fdc_hist = np.empty(np.shape(q_hist))
-        fdc_hist[:] = np.NaN
-        for k in range(np.shape(fdc_hist)[0]):
-            fdc_hist[k,:] = np.sort(q_hist[k,:],0)[::-1]
-        
-        fdc_syn = np.empty(np.shape(q_syn))
-        fdc_syn[:] = np.NaN
-        for k in range(np.shape(fdc_syn)[0]):
-            fdc_syn[k,:] = np.sort(q_syn[k,:], 0)[::-1]
+        # FDC envelopes of site j
+        syn_min, syn_max = env_syn['min'][j], env_syn['max'][j]
+        hist_min, hist_max = env_hist['min'][j], env_hist['max'][j]
 
-        ax = fig.add_subplot(2,5,j+1)
+        ax = fig.add_subplot(nrows,5,j+1)
         # plotting the borders of the historical and synthetic FDC curves
-        ax.semilogy(P, np.min(fdc_syn, 0), c='lightskyblue', label='Synthetic')
-        ax.semilogy(P, np.max(fdc_syn, 0), c='lightskyblue', label='Synthetic')
-        ax.semilogy(P, np.min(fdc_hist, 0), c='lightcoral', label='Historical')
-        ax.semilogy(P, np.max(fdc_hist, 0), c='lightcoral', label='Historical')
-        if j == 0 or j == 5:
+        ax.semilogy(P, syn_min, c='lightskyblue', label='Synthetic')
+        ax.semilogy(P, syn_max, c='lightskyblue', label='Synthetic')
+        ax.semilogy(P, hist_min, c='lightcoral', label='Historical')
+        ax.semilogy(P, hist_max, c='lightcoral', label='Historical')
+        if j % 5 == 0:
             ax.set_ylabel('Q ($10^{6}$ gal/week)')
 
-        ax.fill_between(P, np.min(fdc_syn, 0), np.max(fdc_syn, 0), color='lightskyblue')
-        ax.fill_between(P, np.min(fdc_hist, 0), np.max(fdc_hist, 0), color='lightcoral')
+        ax.fill_between(P, syn_min, syn_max, color='lightskyblue')
+        ax.fill_between(P, hist_min, hist_max, color='lightcoral')
         
         ax.set_title(sites[j], fontsize=18)
         ax.tick_params(axis='both', labelsize=14)
@@ -98,12 +88,31 @@ def plotFDCrange(Qdaily_syn, Qdaily_hist, sites):
     fig.legend(handles, labels, fontsize=18, loc='lower center', ncol=2, 
                frameon=True, bbox_to_anchor=(0.5, 0.07))
     fig.text(0.5, 0.14, 'Probability of exceedance', ha='center', size=20)
-    fig.suptitle('Flow duration curves assuming extreme flooding', fontsize=25)     # modify based on stationary or dynamic dataset
+    fig.suptitle(title, fontsize=25)
     plt.subplots_adjust(top=0.9)
-    fig.savefig('figures/FDCs-dyn.pdf')     # modify based on stationary or dynamic dataset
-    fig.clf()
-    
-Qdaily_syn = np.loadtxt('synthetic-data-dyn/Qdaily-syn-dyn.csv', delimiter=',')    # modify based on stationary or dynamic dataset
-Qdaily_hist = np.loadtxt('historical-data/Qdaily-hist.csv', delimiter=',')
-
-plotFDCrange(Qdaily_syn, Qdaily_hist, all_sitenames)
\ No newline at end of file
+    with stage('savefig', figure=fig_name):
+        fig.savefig(fig_name)
+    plt.close(fig)
+
+fdc_titles = {'stat': 'Flow duration curves assuming stationarity',
+              'dyn': 'Flow duration curves assuming extreme flooding'}
+
+def render(scenario, sites=all_sitenames):
+    '''Renders the FDC artifact of a scenario to figures/FDCs-<scenario>.pdf'''
+    env, meta = load_artifact(artifact_path(fdc_name(scenario)))
+    plotFDCrange(env['syn'], env['hist'], sites, fdc_titles[scenario], 'figures/FDCs-' + scenario + '.pdf')
+
+if __name__ == '__main__':
+    scenario = 'dyn'    # modify based on stationary or dynamic dataset
+
+    # the envelopes are cached in cache/ and only recomputed when the data change
+    # set chunk_years to read the synthetic record in chunks of that many years,
+    # for ensembles that do not fit in memory; the plot is the same
+    chunk_years = None
+    write_fdc_artifact(artifact_path(fdc_name(scenario)), 'historical-data/Qdaily-hist.csv',
+                       'synthetic-data-' + scenario + '/Qdaily-syn-' + scenario + '.csv', chunk_years=chunk_years)
+
+    # getcwd() returns the current working directory of a process
+    assure_path_exists(os.getcwd() + '/figures/')
+    init_plotting()
+    render(scenario)
@@ -0,0 +1,144 @@
+'''Sweeps of STRESS drought/flood scenarios without materializing perturbed
+records.
+
+stress_dynamic.m builds each perturbed record by appending n copies of the
+lowest p% and m copies of the remaining sorted years to the historical
+record, then bootstraps uniformly from it. Drawing a row uniformly from that
+record is the same as drawing a row of the historical record with weight 1,
+of the lowest p% of the sorted record with weight n, or of the remaining
+sorted rows with weight m. The weights are laid over StressModel.source
+(historical rows followed by sorted rows) and sampled in O(1) per draw with
+Walker/Vose alias tables, so no rows are ever copied. The per-site sorted
+matrices, whitening statistics and Cholesky factors of one StressModel are
+reused for every scenario of the sweep.
+'''
+
+import itertools
+import os
+import numpy as np
+
+from stress import StressModel, inflow_files, load_historical, write_synthetic
+
+
+class AliasTable(object):
+    '''Walker/Vose alias table for O(1) draws from a discrete distribution
+
+    @param weights Non-negative weights of the categories
+    '''
+
+    def __init__(self, weights):
+        w = np.asarray(weights, dtype=float)
+        if w.ndim != 1 or len(w) == 0 or np.any(w < 0) or w.sum() <= 0:
+            raise ValueError('weights must be a non-empty vector of non-negative values with a positive sum')
+        K = len(w)
+        scaled = w * K / w.sum()
+        self.prob = np.ones(K)
+        self.alias = np.arange(K)
+        small = [i for i in range(K) if scaled[i] < 1.0]
+        large = [i for i in range(K) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # whatever is left has probability 1 up to rounding
+
+    def draw(self, rng, size):
+        '''Draws category indices of the given size'''
+        k = rng.integers(0, len(self.prob), size=size)
+        u = rng.random(size)
+        return np.where(u < self.prob[k], k, self.alias[k])
+
+
+def scenario_weights(nhist, p, n, m):
+    '''Weights of the rows of StressModel.source (historical rows followed by
+    sorted rows) in a record perturbed by (p, n, m) for one period'''
+    if p == 0:
+        return np.concatenate((np.ones(nhist), np.zeros(nhist)))
+    nlow = int(np.ceil(p * nhist))
+    return np.concatenate((np.ones(nhist), np.full(nlow, float(n)), np.full(nhist - nlow, float(m))))
+
+
+def scenario_grid(ps, ns, ms):
+    '''All (p, n, m) combinations of the given values. Entries of ns and ms
+    may be numbers (one perturbation period) or sequences (one value per
+    period, as in wsc_main_rate.m); combinations whose n and m differ in length
+    are skipped.'''
+    grid = []
+    for p, n, m in itertools.product(ps, ns, ms):
+        n = np.atleast_1d(n).astype(int)
+        m = np.atleast_1d(m).astype(int)
+        if len(n) != len(m):
+            continue
+        grid.append((p, tuple(n.tolist()), tuple(m.tolist())))
+    return grid
+
+
+def scenario_label(p, n, m):
+    '''Directory-safe name of a scenario'''
+    return 'p%g-n%s-m%s' % (p, '_'.join(str(x) for x in np.atleast_1d(n)), '_'.join(str(x) for x in np.atleast_1d(m)))
+
+
+class ScenarioSweep(object):
+    '''Generates synthetic records for many (p, n, m) scenarios from one StressModel
+
+    @param model A StressModel, or a sequence of historical records to build one from
+    '''
+
+    def __init__(self, model):
+        self.model = model if isinstance(model, StressModel) else StressModel(model)
+        self._tables = {}
+
+    def alias_table(self, p, n, m):
+        '''Alias table of one perturbation period, shared by every scenario that uses it'''
+        key = (int(np.ceil(p * self.model.nhist)) if p > 0 else 0, int(n), int(m))
+        if key not in self._tables:
+            self._tables[key] = AliasTable(scenario_weights(self.model.nhist, p, n, m))
+        return self._tables[key]
+
+    def draw_indices(self, rng, num_realizations, num_syn_years, p=0, n=(1,), m=(1,)):
+        '''Draws rows of StressModel.source for every realization, year and
+        week; same layout as StressModel.draw_indices'''
+        nQ, period = self.model.record_lengths(num_syn_years, p, n, m)
+        n = np.atleast_1d(n)
+        m = np.atleast_1d(m)
+        nyears = len(period)
+        rows = np.empty((num_realizations, nyears, self.model.nweeks), dtype=np.int64)
+        for k in np.unique(period):
+            years = np.flatnonzero(period == k)
+            table = self.alias_table(p, n[k], m[k])
+            rows[:, years, :] = table.draw(rng, (num_realizations, len(years), self.model.nweeks))
+        return rows
+
+    def generate(self, num_realizations, num_syn_years, p=0, n=(1,), m=(1,), seed=None):
+        '''Synthetic records of one scenario; same output as StressModel.generate'''
+        rng = np.random.default_rng(seed)
+        rows = self.draw_indices(rng, num_realizations, num_syn_years, p, n, m)
+        return self.model.generate_from_indices(rows)
+
+    def sweep(self, scenarios, num_realizations, num_syn_years, seed=None):
+        '''Yields (scenario, Qs) for every (p, n, m) scenario, each drawn from
+        its own child of one master seed'''
+        children = np.random.SeedSequence(seed).spawn(len(scenarios))
+        for scenario, child in zip(scenarios, children):
+            p, n, m = scenario
+            yield scenario, self.generate(num_realizations, num_syn_years, p, n, m, seed=child)
+
+
+if __name__ == '__main__':
+    num_syn_realizations = 1000     # number of synthetic realizations
+    num_syn_years = 1       # number of synthetic years
+    outdir = 'synthetic-data-sweep'
+
+    # drought/flood scenarios: the lowest p% of years are n times as likely
+    # and the remaining years m times as likely as in the historical record
+    scenarios = scenario_grid([0.1, 0.25, 0.5], [1, 2, 5], [1, 2, 8, 20])
+
+    sweep = ScenarioSweep(load_historical())
+    for (p, n, m), Qs in sweep.sweep(scenarios, num_syn_realizations, num_syn_years, seed=20170711):
+        write_synthetic(Qs, os.path.join(outdir, scenario_label(p, n, m)), num_syn_years, inflow_files)
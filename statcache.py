@@ -0,0 +1,145 @@
+'''Content-addressed on-disk cache of derived statistics.
+
+Each entry is keyed on a hash of the contents of its input file(s) and of
+the parameters it was computed with, so an entry goes stale as soon as a
+source file changes and is simply never looked up again. Entries are .npz
+files in the cache directory (nested dicts of arrays are stored as in
+artifacts.py). Reading an entry marks it as recently used, and the least
+recently used entries are evicted whenever the directory grows beyond
+max_bytes.
+
+File digests are remembered in <cachedir>/digests.json by path, size and
+modification time, so unchanged files are not hashed again. Like the
+entries, the digest file is replaced atomically, so jobs sharing a cache
+directory never read it half-written.
+'''
+
+import hashlib
+import json
+import os
+import numpy as np
+
+from artifacts import flatten, unflatten
+
+default_cachedir = 'cache'
+default_max_bytes = 2*1024**3
+
+
+def file_digest(path, blocksize=1 << 20):
+    '''SHA-1 digest of the contents of a file'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+
+def _jsonable(obj):
+    '''Makes NumPy values serializable for the cache key'''
+    return np.asarray(obj).tolist()
+
+
+class StatCache(object):
+    '''Size-bounded, least-recently-used cache of derived statistics'''
+
+    def __init__(self, cachedir=default_cachedir, max_bytes=default_max_bytes):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self._digests = None
+
+    def _digests_path(self):
+        return self.cachedir + '/digests.json'
+
+    def _read_digests(self):
+        '''The remembered digests; empty if the file is missing or unreadable'''
+        try:
+            with open(self._digests_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def digest(self, path):
+        '''Digest of a file, rehashed only when its size or modification time changes'''
+        if self._digests is None:
+            self._digests = self._read_digests()
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self._digests.get(os.path.abspath(path))
+        if entry is None or entry[0] != stamp:
+            entry = [stamp, file_digest(path)]
+            # keep the digests other jobs have added since they were read
+            self._digests = self._read_digests()
+            self._digests[os.path.abspath(path)] = entry
+            self._makedirs()
+            tmp = '%s.%d.tmp' % (self._digests_path(), os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self._digests, f)
+            os.replace(tmp, self._digests_path())
+        return entry[1]
+
+    def key(self, kind, inputs, params):
+        '''Cache key of a kind of statistic computed from the files inputs with params'''
+        ident = {'kind': kind, 'inputs': [self.digest(path) for path in inputs], 'params': params}
+        return kind + '-' + hashlib.sha1(json.dumps(ident, sort_keys=True, default=_jsonable).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.cachedir + '/' + key + '.npz'
+
+    def _makedirs(self):
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def get(self, key):
+        '''Returns the cached entry for key, or None'''
+        path = self._path(key)
+        # another job sharing the cache directory may evict the entry at any time
+        try:
+            os.utime(path)    # mark as recently used
+            with np.load(path) as f:
+                return unflatten(dict(f))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, arrays):
+        '''Stores a nested dict of arrays under key and evicts old entries'''
+        self._makedirs()
+        tmp = '%s/%s.%d.tmp' % (self.cachedir, key, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **flatten(arrays))
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache fits in max_bytes'''
+        entries = []
+        for filename in os.listdir(self.cachedir):
+            # entries other jobs are still writing are not counted
+            if filename.endswith('.npz') and '.tmp' not in filename:
+                path = self.cachedir + '/' + filename
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total = total - size
+
+    def cached(self, kind, inputs, params, compute):
+        '''Returns the cached result of compute() for these inputs and params,
+        computing and storing it on a miss'''
+        key = self.key(kind, inputs, params)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
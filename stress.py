@@ -0,0 +1,183 @@
+'''Vectorized NumPy port of the Scenario-Tunable Regional Synthetic Streamflow
+(STRESS) generator in stress_dynamic.m.
+
+stress_dynamic.m is called once per realization by wsc_main_rate.m and redoes
+the log transform, weekly moments, whitening and both Cholesky factorizations
+for every site and year on every call, even though none of them depend on the
+random draw. StressModel computes these once per site, draws the bootstrap
+index cube for all realizations at once and applies U/U_shifted as batched
+matrix products.
+
+The output files use the same <site>_SYNxx.csv layout written by
+wsc_main_rate.m (one realization per row, num_syn_years*52 columns), so
+flows_by_site.py and weekly-moments.py read them unchanged.
+'''
+
+import os
+import numpy as np
+
+inflow_dir = 'historical-data'
+inflow_files = ['trainingLittleRiverRaleighInflow','trainingOWASAInflow','trainingClaytonGageInflow',
+                'trainingCrabtreeCreekInflow','trainingFallsLakeInflow','trainingJordanLakeInflow',
+                'trainingLakeWBInflow','trainingLillingtonInflow','trainingLittleRiverInflow','trainingMichieInflow']
+
+
+def batch_corr(X):
+    '''Pearson correlation matrices of the columns of each stacked matrix in X (... x nobs x nvars)'''
+    Xc = X - X.mean(axis=-2, keepdims=True)
+    cov = np.matmul(np.swapaxes(Xc, -1, -2), Xc)
+    d = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    return cov / (d[..., :, None] * d[..., None, :])
+
+
+def upper_cholesky(C):
+    '''Upper triangular U with U'U = C, as returned by MATLAB's chol'''
+    return np.swapaxes(np.linalg.cholesky(C), -1, -2)
+
+
+class StressModel(object):
+    '''Per-site quantities of stress_dynamic.m that do not depend on the random draw.
+
+    @param Q_historical A sequence of nhist_years x 52 historical inflow matrices, one per site
+    '''
+
+    def __init__(self, Q_historical):
+        Q_historical = [np.asarray(q, dtype=float) for q in Q_historical]
+        if len(Q_historical) == 0:
+            raise ValueError('Q_historical must contain one or more 2-D matrices.')
+        for q in Q_historical[1:]:
+            if q.shape != Q_historical[0].shape:
+                raise ValueError('All matrices in Q_historical must be the same size.')
+        Q = np.stack(Q_historical)    # nsites x nhist_years x 52
+        self.nsites, self.nhist, self.nweeks = Q.shape
+        half = self.nweeks // 2
+
+        # means, stdevs and whitened residuals of the original record
+        logQ = np.log(Q)
+        self.weekly_mean = logQ.mean(axis=1)
+        self.weekly_stdev = logQ.std(axis=1, ddof=1)
+        self.Z = (logQ - self.weekly_mean[:, None, :]) / self.weekly_stdev[:, None, :]
+
+        # whitening is monotonic in each week, so the whitened residuals of the
+        # sorted record are the sorted whitened residuals; the perturbed record
+        # is then the historical rows followed by copies of these sorted rows
+        self.Z_sorted = np.sort(self.Z, axis=1)
+        self.source = np.concatenate((self.Z, self.Z_sorted), axis=1)
+
+        # shift the residual record by 26 weeks; the appended years do not
+        # preserve correlation so only the historical residuals are used
+        Z_vector = self.Z.reshape(self.nsites, -1)
+        Z_shifted = Z_vector[:, half:-half].reshape(self.nsites, self.nhist - 1, self.nweeks)
+        self.U = upper_cholesky(batch_corr(self.Z))
+        self.U_shifted = upper_cholesky(batch_corr(Z_shifted))
+
+    def record_lengths(self, num_syn_years, p=0, n=(1,), m=(1,)):
+        '''Returns the length of the perturbed historical record in each of the
+        num_syn_years+1 generated years and the perturbation period of each year.'''
+        nyears = num_syn_years + 1
+        if p < 0:
+            raise ValueError('p must be non-negative.')
+        if p == 0:
+            return np.full(nyears, self.nhist), np.zeros(nyears, dtype=int)
+        n = np.asarray(n, dtype=int)
+        m = np.asarray(m, dtype=int)
+        if n.shape != m.shape or n.ndim != 1:
+            raise ValueError('n and m must be vectors of the same length.')
+        period_length = nyears / len(n)
+        period = np.ceil(np.arange(1, nyears + 1) / period_length).astype(int)
+        period = np.minimum(period, len(n)) - 1
+        nlow = int(np.ceil(p * self.nhist))
+        nQ = self.nhist + nlow * n[period] + (self.nhist - nlow) * m[period]
+        return nQ, period
+
+    def draw_indices(self, rng, num_realizations, num_syn_years, p=0, n=(1,), m=(1,)):
+        '''Draws the bootstrap rows (Random_Matrix) of all realizations at once.
+
+        Returns a num_realizations x (num_syn_years+1) x 52 array of rows into
+        self.source, the same for every site in a realization.'''
+        nQ, period = self.record_lengths(num_syn_years, p, n, m)
+        R = rng.integers(0, nQ[None, :, None], size=(num_realizations, len(nQ), self.nweeks))
+        if p == 0:
+            return R
+
+        # map a row of the perturbed record onto the historical or sorted rows
+        nlow = int(np.ceil(p * self.nhist))
+        nhigh = self.nhist - nlow
+        nlow_rows = (nlow * np.asarray(n, dtype=int)[period])[None, :, None]
+        appended = R - self.nhist
+        high = appended - nlow_rows
+        rows = np.where(appended < nlow_rows,
+                        self.nhist + appended % max(nlow, 1),
+                        self.nhist + nlow + high % max(nhigh, 1))
+        return np.where(R < self.nhist, R, rows)
+
+    def generate_from_indices(self, rows):
+        '''Applies the correlation structure and back-transforms the bootstrapped
+        residuals selected by rows (see draw_indices).
+
+        Returns a list with one num_realizations x (num_syn_years*52) array per site.'''
+        nreal, nyears, nweeks = rows.shape
+        half = nweeks // 2
+        weeks = np.arange(nweeks)
+        Qs = []
+        for k in range(self.nsites):
+            Qs_uncorr = self.source[k][rows, weeks]
+            # shift the bootstrapped values so that U and U_shifted are matched
+            # with the same values and the halves can be stitched together
+            Qs_uncorr_shifted = Qs_uncorr.reshape(nreal, -1)[:, half:-half].reshape(nreal, nyears - 1, nweeks)
+
+            # only the back half of each correlated matrix is kept
+            Qs_log = np.empty((nreal, nyears - 1, nweeks))
+            Qs_log[:, :, :half] = np.matmul(Qs_uncorr_shifted, self.U_shifted[k][:, half:])
+            Qs_log[:, :, half:] = np.matmul(Qs_uncorr[:, 1:, :], self.U[k][:, half:])
+
+            Qsk = np.exp(Qs_log * self.weekly_stdev[k] + self.weekly_mean[k])
+            Qs.append(Qsk.reshape(nreal, -1))
+        return Qs
+
+    def generate(self, num_realizations, num_syn_years, p=0, n=(1,), m=(1,), seed=None):
+        '''Generates num_realizations synthetic records of num_syn_years years.
+
+        @param p The fraction of lowest streamflows that are perturbed; 0 gives stationary flows
+        @param n The number of copies of the lowest p% of flows in each perturbation period
+        @param m The number of copies of the highest (100-p)% of flows in each perturbation period
+        @param seed A seed or np.random.Generator for the bootstrap draw
+        '''
+        rng = np.random.default_rng(seed)
+        rows = self.draw_indices(rng, num_realizations, num_syn_years, p, n, m)
+        return self.generate_from_indices(rows)
+
+
+def load_historical(datadir=inflow_dir, sites=inflow_files):
+    '''Loads the nhist_years x 52 historical record of each site'''
+    return [np.loadtxt(datadir + '/' + site + '.csv', delimiter=',') for site in sites]
+
+
+def synthetic_filename(datadir, site, num_syn_years):
+    '''Path of the <site>_SYNxx.csv file holding num_syn_years-long realizations'''
+    return datadir + '/' + site + '_SYN%02d.csv' % num_syn_years
+
+
+def write_synthetic(Qs, datadir, num_syn_years, sites=inflow_files):
+    '''Writes one <site>_SYNxx.csv file per site, one realization per row'''
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    for site, Qsk in zip(sites, Qs):
+        np.savetxt(synthetic_filename(datadir, site, num_syn_years), Qsk, delimiter=',')
+
+
+if __name__ == '__main__':
+    # same test case as wsc_main_rate.m
+    num_syn_realizations = 1000     # number of synthetic realizations
+    num_syn_years = 1       # number of synthetic years
+    p_dyn = 0.25    # low X% of streamflows
+    p_stat = 0
+    n = [1, 1, 1, 1, 1, 1]      # how much more likely are those low flows? (1 = same as historical)
+    m = [1, 1, 8, 12, 20, 20]   # how much more likely are the remaining flows? (i.e. wettest (1 - X)%)
+
+    model = StressModel(load_historical())
+    rng = np.random.default_rng()
+    Qs_dyn = model.generate(num_syn_realizations, num_syn_years, p_dyn, n, m, seed=rng)
+    Qs_stat = model.generate(num_syn_realizations, num_syn_years, p_stat, n, m, seed=rng)
+    write_synthetic(Qs_dyn, 'synthetic-data-dyn', num_syn_years)
+    write_synthetic(Qs_stat, 'synthetic-data-stat', num_syn_years)
@@ -0,0 +1,129 @@
+'''Parallel, deterministically seeded STRESS generation with sharded output.
+
+The realization range is split into fixed-size blocks. Each block draws from
+its own child of one master np.random.SeedSequence, so the realizations do not
+depend on how many worker processes generate them. Each block is written as
+one flowstore.py shard per site, and a JSON manifest
+(<datadir>/SYNxx-manifest.json) records the shards so that load_synthetic()
+can read them back as one logical <site>_SYNxx dataset. Directories without a
+manifest fall back to the <site>_SYNxx files written by stress.py and
+wsc_main_rate.m.
+'''
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from flowstore import load_flows, save_flows, source_path
+from stress import StressModel, inflow_files, load_historical, synthetic_filename
+
+_worker_model = None
+
+
+def _init_worker(Q_historical):
+    '''Builds the StressModel once per worker process'''
+    global _worker_model
+    _worker_model = StressModel(Q_historical)
+
+
+def _generate_block(args):
+    '''Generates and writes the shards of one block of realizations'''
+    datadir, sites, block, start, stop, seed, num_syn_years, p, n, m = args
+    Qs = _worker_model.generate(stop - start, num_syn_years, p, n, m, seed=seed)
+    files = {}
+    for site, Qsk in zip(sites, Qs):
+        filename = shard_filename(site, num_syn_years, block)
+        save_flows(datadir + '/' + filename, Qsk, sites=site)
+        files[site] = filename
+    return {'block': block, 'start': start, 'stop': stop, 'files': files}
+
+
+def shard_filename(site, num_syn_years, block):
+    '''Name of the shard holding one block of realizations of a site'''
+    return site + '_SYN%02d-%05d.npy' % (num_syn_years, block)
+
+
+def manifest_filename(datadir, num_syn_years):
+    '''Path of the manifest listing the shards of the SYNxx dataset'''
+    return datadir + '/SYN%02d-manifest.json' % num_syn_years
+
+
+def generate_sharded(Q_historical, datadir, num_realizations, num_syn_years, p=0, n=(1,), m=(1,),
+                     seed=None, block_size=250, max_workers=None, sites=inflow_files):
+    '''Generates num_realizations synthetic records on a process pool and writes
+    them as shards of block_size realizations.
+
+    The output is bit-identical for a given seed and block_size whatever the
+    value of max_workers. Returns the manifest.
+
+    @param seed An integer master seed; a fresh one is drawn (and recorded in the manifest) if None
+    '''
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    master = np.random.SeedSequence(seed)
+    starts = list(range(0, num_realizations, block_size))
+    children = master.spawn(len(starts))
+    tasks = [(datadir, list(sites), b, start, min(start + block_size, num_realizations), children[b],
+              num_syn_years, p, list(n), list(m)) for b, start in enumerate(starts)]
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(Q_historical,)) as pool:
+        shards = list(pool.map(_generate_block, tasks))
+
+    manifest = {'num_realizations': num_realizations, 'num_syn_years': num_syn_years,
+                'seed': master.entropy, 'block_size': block_size,
+                'p': p, 'n': list(n), 'm': list(m), 'sites': list(sites), 'shards': shards}
+    with open(manifest_filename(datadir, num_syn_years), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(datadir, num_syn_years):
+    '''Returns the manifest of the SYNxx dataset in datadir, or None if it is not sharded'''
+    path = manifest_filename(datadir, num_syn_years)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def iter_synthetic(datadir, site, num_syn_years):
+    '''Yields the realizations of a site one shard at a time as memory maps.
+    An unsharded dataset is yielded as a single block read from <site>_SYNxx.'''
+    manifest = read_manifest(datadir, num_syn_years)
+    if manifest is None:
+        yield load_flows(synthetic_filename(datadir, site, num_syn_years))
+        return
+    for shard in manifest['shards']:
+        yield load_flows(datadir + '/' + shard['files'][site])
+
+
+def synthetic_sources(datadir, site, num_syn_years):
+    '''The files the realizations of a site are read from'''
+    manifest = read_manifest(datadir, num_syn_years)
+    if manifest is None:
+        return [source_path(synthetic_filename(datadir, site, num_syn_years))]
+    return [manifest_filename(datadir, num_syn_years)] + \
+        [datadir + '/' + shard['files'][site] for shard in manifest['shards']]
+
+
+def load_synthetic(datadir, site, num_syn_years):
+    '''Loads all realizations of a site as one n_realizations x (num_syn_years*52) array'''
+    blocks = list(iter_synthetic(datadir, site, num_syn_years))
+    if len(blocks) == 1:
+        return blocks[0]
+    return np.concatenate(blocks, axis=0)
+
+
+if __name__ == '__main__':
+    # same test case as wsc_main_rate.m
+    num_syn_realizations = 1000     # number of synthetic realizations
+    num_syn_years = 1       # number of synthetic years
+    n = [1, 1, 1, 1, 1, 1]      # how much more likely are those low flows? (1 = same as historical)
+    m = [1, 1, 8, 12, 20, 20]   # how much more likely are the remaining flows? (i.e. wettest (1 - X)%)
+    seed = 20170711     # master seed
+
+    Qh = load_historical()
+    generate_sharded(Qh, 'synthetic-data-dyn', num_syn_realizations, num_syn_years, 0.25, n, m, seed=seed)
+    generate_sharded(Qh, 'synthetic-data-stat', num_syn_realizations, num_syn_years, 0, n, m, seed=seed + 1)
@@ -0,0 +1,213 @@
+'''Regenerates the whole validation report in one run.
+
+Every historical and synthetic (stationary and dynamic) dataset, including
+the Qdaily matrices, is loaded at most once into a shared in-memory DataCache, and only if one of its
+statistics is missing from the statcache.py cache. Every statistic of every site is then
+computed in real and log space and written as an artifact (see compute.py),
+and each artifact is handed to a process pool that renders its PDF with the
+non-interactive Agg backend while the remaining statistics are computed.
+The FDCs and the cross-site and autocorrelations of each scenario are
+computed from its Qdaily matrices.
+
+    python validate.py [max_workers]
+
+Set STRESS_REPORT=report.json and/or STRESS_PROGRESS=1 to get a timing and
+memory report of every stage and a live progress log (see instrument.py).
+'''
+
+import importlib
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from artifacts import artifact_path, save_artifact
+from compute import convergence_name, correlation_name, extremes_name, fdc_name, moments_name, spaces
+from convergence import cached_internal_variability
+from correlation import write_correlation_artifact
+from extremes import cached_site_extremes
+from ensemble import SyntheticEnsemble
+from fdc import write_fdc_artifact
+from flows_by_site import all_sites
+from flowstore import load_flows
+import instrument
+from instrument import stage
+from moments import cached_moments
+from statcache import StatCache
+
+all_sitenames = ['Little River Raleigh', 'OWASA', 'Clayton', 'Crabtree Creek', 'Falls Lake', 'Jordan Lake',
+                 'Lake Wheeler/Benson', 'Lillington', 'Little River', 'Lake Michie']
+
+scenarios = ['stat', 'dyn']
+
+
+class DataCache(object):
+    '''Loads each historical and synthetic record once and keeps it, and its
+    log transform, in memory until the site is released. The Qdaily matrices
+    are released as the site 'Qdaily'.'''
+
+    def __init__(self, hist_datadir='historical-data', num_syn_years=60):
+        self.hist_datadir = hist_datadir
+        self.num_syn_years = num_syn_years
+        self._data = {}
+
+    def _get(self, key, load):
+        if key not in self._data:
+            self._data[key] = load()
+        return self._data[key]
+
+    def historical(self, site, space='real'):
+        '''The nhist_years x 52 historical record of a site'''
+        if space == 'log':
+            return self._get((site, 'hist', 'log'), lambda: np.log(self.historical(site)))
+        return self._get((site, 'hist', 'real'),
+                         lambda: np.asarray(load_flows(self.hist_datadir + '/' + site + '.csv')))
+
+    def synthetic(self, site, scenario, space='real'):
+        '''The n_realizations x n_syn_years x 52 synthetic record of a site'''
+        if space == 'log':
+            return self._get((site, scenario, 'log'), lambda: np.log(self.synthetic(site, scenario)))
+        return self._get((site, scenario, 'real'),
+                         lambda: np.asarray(SyntheticEnsemble('synthetic-data-' + scenario, self.num_syn_years,
+                                                              [site]).site_values(site)))
+
+    def qdaily_path(self, scenario=None):
+        '''Path of the historical Qdaily matrix, or of the synthetic one of a scenario'''
+        if scenario is None:
+            return self.hist_datadir + '/Qdaily-hist.csv'
+        return 'synthetic-data-' + scenario + '/Qdaily-syn-' + scenario + '.csv'
+
+    def qdaily(self, scenario=None):
+        '''The historical Qdaily matrix, or the synthetic one of a scenario'''
+        return self._get(('Qdaily', scenario or 'hist'), lambda: np.asarray(load_flows(self.qdaily_path(scenario))))
+
+    def release(self, site):
+        '''Drops every record of a site from memory'''
+        for key in [key for key in self._data if key[0] == site]:
+            del self._data[key]
+
+
+def _init_renderer():
+    '''Selects the non-interactive backend in each rendering process'''
+    import matplotlib
+    matplotlib.use('Agg')
+    # forget the records inherited from the parent process
+    instrument.drain()
+
+
+def _render(task, **labels):
+    '''Renders one artifact in a worker process. Returns the task and the
+    instrumentation records of the worker, if any.'''
+    with stage('render', kind=task[0], **labels):
+        _render_task(task)
+    return task, instrument.drain()
+
+
+def _render_task(task):
+    import matplotlib
+    from matplotlib import pyplot as plt
+    kind = task[0]
+    # each script sets its own rcParams
+    matplotlib.rcdefaults()
+    try:
+        if kind == 'fdc':
+            module = importlib.import_module('plotFDCrange')
+            module.assure_path_exists('figures/')
+            module.init_plotting()
+            module.render(task[1], task[2])
+        elif kind == 'correlation':
+            module = importlib.import_module('correlation')
+            module.render_correlation(*task[1:])
+        elif kind == 'extremes':
+            module = importlib.import_module('extremes')
+            module.render_sdf(*task[1:])
+        elif kind == 'moments':
+            module = importlib.import_module('weekly-moments')
+            module.init_plotting()
+            module.render_moments(*task[1:])
+        else:
+            module = importlib.import_module('internal_variability')
+            module.render_internal_variability(*task[1:])
+    finally:
+        # the workers are long-lived, so no figure may stay open in pyplot
+        plt.close('all')
+
+
+def run(scenarios=scenarios, sites=all_sites, sitenames=all_sitenames, quantile=1.0, drought=False,
+        num_syn_years=60, max_workers=None, seed=None, statcache=None):
+    '''Computes and renders every validation figure of every site and scenario.
+    Returns the rendered tasks.
+
+    With instrument.py enabled, the stages run for each site are labelled with
+    the site and the stages of the rendering processes are merged into the
+    report.'''
+    cache = DataCache(num_syn_years=num_syn_years)
+    statcache = StatCache() if statcache is None else statcache
+    # created once here, as the render tasks run in parallel and in any order
+    os.makedirs('figures', exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_renderer) as pool:
+        futures = []
+        for scenario in scenarios:
+            hist_path, syn_path = cache.qdaily_path(), cache.qdaily_path(scenario)
+            write_fdc_artifact(artifact_path(fdc_name(scenario)), hist_path, syn_path, cache=statcache,
+                               hist_data=cache.qdaily, syn_data=lambda: cache.qdaily(scenario))
+            futures.append(pool.submit(_render, ('fdc', scenario, sitenames)))
+            for space in spaces:
+                path = artifact_path(correlation_name(scenario, space))
+                data = lambda: (cache.qdaily(), cache.qdaily(scenario))
+                write_correlation_artifact(path, hist_path, syn_path, space=space, cache=statcache, data=data)
+                fig_name = 'figures/correlation-' + scenario + '-' + space + '.pdf'
+                futures.append(pool.submit(_render, ('correlation', path, sitenames, fig_name)))
+        cache.release('Qdaily')
+
+        for site, sitename in zip(sites, sitenames):
+            for scenario in scenarios:
+                with stage('site', site=site, scenario=scenario):
+                    syn_datadir = 'synthetic-data-' + scenario
+                    meta = {'site': site, 'syn_datadir': syn_datadir, 'num_syn_years': num_syn_years}
+                    data = lambda space: (cache.historical(site, space), cache.synthetic(site, scenario, space))
+                    result = cached_moments(site, cache.hist_datadir, syn_datadir, num_syn_years, seed, statcache,
+                                            data)
+                    path = artifact_path(moments_name(site, scenario))
+                    save_artifact(path, result, meta)
+                    futures.append(pool.submit(_render, ('moments', path, sitename, scenario, site), site=site))
+
+                    for extreme_quantile, extreme_drought in ((0.2, True), (0.8, False)):
+                        data = lambda: (cache.historical(site), cache.synthetic(site, scenario))
+                        result = cached_site_extremes(site, cache.hist_datadir, syn_datadir, num_syn_years,
+                                                      extreme_quantile, extreme_drought, statcache, data)
+                        path = artifact_path(extremes_name(site, extreme_quantile, extreme_drought, scenario))
+                        save_artifact(path, result, dict(meta, quantile=extreme_quantile, drought=extreme_drought))
+                        fig_name = 'figures/sdf-' + site + '-' + ('drought' if extreme_drought else 'flood') + '-' + \
+                            scenario + '.pdf'
+                        futures.append(pool.submit(_render, ('extremes', path, sitename, fig_name), site=site))
+
+                    for space in spaces:
+                        data = lambda: cache.synthetic(site, scenario, space)
+                        result = cached_internal_variability(site, syn_datadir, num_syn_years, space, quantile, drought,
+                                                             cache=statcache, data=data)
+                        path = artifact_path(convergence_name(site, space, quantile, drought, scenario))
+                        save_artifact(path, result, dict(meta, space=space, quantile=quantile, drought=drought))
+                        fig_name = 'figures/internal-variability-' + site + '-' + space + '-' + scenario + '.pdf'
+                        futures.append(pool.submit(_render, ('convergence', path, sitename, space, drought, fig_name),
+                                                   site=site))
+            cache.release(site)
+
+        tasks = []
+        error = None
+        for future in futures:
+            # merge the records of every task before raising the first failure
+            try:
+                task, records = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            instrument.merge(records)
+            tasks.append(task)
+        if error is not None:
+            raise error
+        return tasks
+
+
+if __name__ == '__main__':
+    run(max_workers=int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -3,16 +3,20 @@ weekly flows (blue) as well as their means and standard deviations at
 Marietta. Also plots p-values from rank-sum test for differences in the median
 between historical and synthetic flows and from Levene's test for differences
 in the variance between historical and synthetic flows. The site being plotted
-can be changed on line 84.'''
+can be changed on line 175.
+
+The statistics are computed by moments.py and stored as an artifact (see
+compute.py); this file only renders them. The p-values of all sites can be
+computed without plotting by moments.validate_sites().'''
 
 from __future__ import division
 import numpy as np 
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas as pd 
-import seaborn as sns
-from scipy import stats
 import os
+from artifacts import artifact_path, load_artifact
+from boxstats import bxp_stats
+from compute import moments_name
+from instrument import instrumented, stage
+from moments import write_moments_artifact
 
 all_sites = ['trainingLittleRiverRaleighInflow','trainingOWASAInflow','trainingClaytonGageInflow',
              'trainingCrabtreeCreekInflow','trainingFallsLakeInflow','trainingJordanLakeInflow',
@@ -29,11 +33,11 @@ def assure_path_exists(path):
     dir = os.path.dirname(path)
     if not os.path.exists(dir):
         os.makedirs(dir)
-                
-assure_path_exists(os.getcwd() + '/figures/')
 
 def init_plotting():
     '''Sets plotting characteristics'''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     sns.set_style('whitegrid')
     plt.rcParams['figure.figsize'] = (14, 14)
     plt.rcParams['font.size'] = 18
@@ -44,10 +48,9 @@ def init_plotting():
     plt.rcParams['xtick.labelsize'] = plt.rcParams['font.size']
     plt.rcParams['ytick.labelsize'] = plt.rcParams['font.size']
 
-init_plotting()
-
 def set_box_color(bp, color):
     '''Sets colors of boxplot elements'''
+    import matplotlib.pyplot as plt
     plt.setp(bp['boxes'], color=color)
     plt.setp(bp['whiskers'], color=color, linestyle='solid')
     plt.setp(bp['caps'], color=color)
@@ -55,10 +58,13 @@ def set_box_color(bp, color):
 
 # thanks to http://stackoverflow.com/questions/16592222/matplotlib-group-boxplots
 def boxplots(syn, hist, xticks=True, legend=True, loc='upper right'):
-  '''Makes boxplots'''
+  '''Makes boxplots from the boxstats.box_stats of the synthetic and historical data'''
+  import matplotlib.pyplot as plt
   # bpl = boxplots of synthetic data, bpr = boxplots of bootstrapped historical data
-  bpl = plt.boxplot(syn, positions=np.arange(1,53)-0.15, sym='', widths=0.25, patch_artist=True)
-  bpr = plt.boxplot(hist, positions=np.arange(1,53)+0.15, sym='', widths=0.25, patch_artist=True)
+  bpl = plt.gca().bxp(bxp_stats(syn), positions=np.arange(1,53)-0.15, widths=0.25, patch_artist=True,
+                      showfliers=False)
+  bpr = plt.gca().bxp(bxp_stats(hist), positions=np.arange(1,53)+0.15, widths=0.25, patch_artist=True,
+                      showfliers=False)
   set_box_color(bpl, 'lightskyblue')
   set_box_color(bpr, 'lightcoral')
 
@@ -81,30 +87,28 @@ def boxplots(syn, hist, xticks=True, legend=True, loc='upper right'):
 
 
 # Make statistical validation plots of weekly moments
-s = 5       # index of the site to be plotted
 space = ['real', 'log']
 legend_loc = ['upper right', 'lower left']
-site = all_sites[s]
-sitename = all_sitenames[s]
 
-H = np.loadtxt('historical-data/' + site + '.csv', delimiter=',')
-S = np.loadtxt('synthetic-data-stat/' + site + '_SYN60.csv', delimiter=',')     # modify based on stationary or dynamic dataset
-S = S.reshape((np.shape(S)[0], int(np.shape(S)[1]/52),52)) # n_realizations x n_syn_years x 52
+@instrumented('plot')
+def render_moments(path, sitename, scenario, fig_label=None):
+  '''Renders a weekly moments artifact written by moments.write_moments_artifact.
+  fig_label replaces sitename in the figure file names.'''
+  if fig_label is None:
+    fig_label = sitename
+  import matplotlib.pyplot as plt
+  assure_path_exists(os.getcwd() + '/figures/')
+  result, meta = load_artifact(path)
 
-for j in range(len(space)):
-    if j == 1:
-        H = np.log(H)
-        S = np.log(S)
-    N = H.shape[0]
-    num_resamples = np.shape(S)[0]
-    r = np.random.randint(N, size=(N, num_resamples))
+  for j in range(len(space)):
+    r = result[space[j]]
 
     fig = plt.figure()
 
     # Plot boxplot of weekly totals from n_realizations*n_syn_years
     # and all historical years
     ax = fig.add_subplot(5,1,1)
-    boxplots(S.reshape((np.shape(S)[0]*np.shape(S)[1], 52)), H, xticks=False, legend=True,
+    boxplots(r['weekly']['syn'], r['weekly']['hist'], xticks=False, legend=True,
                 loc=legend_loc[j])
     if j == 0:
         ax.set_ylabel('Q ($10^{6}$ week)')
@@ -115,7 +119,7 @@ for j in range(len(space)):
         
     ax = fig.add_subplot(5,1,2)
     # get weekly means throughout all n_syn_years and n_realizations
-    boxplots(S.mean(axis=1), H[r].mean(axis=0), xticks=False, legend=False)
+    boxplots(r['mean']['syn'], r['mean']['hist'], xticks=False, legend=False)
     ax.set_ylabel('$\hat{\mu}_Q$')
     
     if j == 1:
@@ -125,7 +129,7 @@ for j in range(len(space)):
 
     ax = fig.add_subplot(5,1,3)
     # get weekly std deviations throughout all n_syn_years and n_realizations
-    boxplots(S.std(axis=1), H[r].std(axis=0), xticks=False, legend=False)
+    boxplots(r['std']['syn'], r['std']['hist'], xticks=False, legend=False)
     ax.set_ylabel('$\hat{\sigma}_Q$')
     if j == 1:
         ax.set_yticks(np.arange(0, 3, 1))
@@ -135,12 +139,8 @@ for j in range(len(space)):
     # Wilcoxon's rank-sum test for weekly medians and Levene's test for weekly variances
     # Ideally Wilconxon's p ~= 1.0
     # Ideally Levene's p ~= 1.0
-    wilcoxon_pvals = np.zeros(52)
-    levene_pvals = np.zeros(52)
-
-    for i in range(52):
-        wilcoxon_pvals[i] = stats.ranksums(H[:,i], S.reshape((np.shape(S)[0]*np.shape(S)[1], 52))[:,i])[1]
-        levene_pvals[i] = stats.levene(H[:,i], S.reshape((np.shape(S)[0]*np.shape(S)[1], 52))[:,i])[1]
+    wilcoxon_pvals = r['ranksums']
+    levene_pvals = r['levene']
 
     ax = fig.add_subplot(5,1,4)
     ax.bar(np.arange(1,53)-0.4, wilcoxon_pvals, facecolor='0.7', edgecolor='None')
@@ -164,6 +164,22 @@ for j in range(len(space)):
         fig.suptitle('Log space ' + '(' + sitename + ')')
 
     fig.tight_layout()
-    fig.savefig('figures/moments_pvalues_' + space[j] + '_' + sitename + '-stat.pdf')   # modify based on stationary or dynamic dataset
+    fig_name = 'figures/moments_pvalues_' + space[j] + '_' + fig_label + '-' + scenario + '.pdf'
+    with stage('savefig', figure=fig_name):
+      fig.savefig(fig_name)
+
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    s = 5       # index of the site to be plotted
+    scenario = 'stat'   # modify based on stationary or dynamic dataset
+    relative_accuracy = None    # e.g. 0.005 to summarize very large ensembles with quantile sketches
+    site = all_sites[s]
+    sitename = all_sitenames[s]
 
-    fig.clf()
+    path = artifact_path(moments_name(site, scenario))
+    write_moments_artifact(path, site, syn_datadir='synthetic-data-' + scenario, num_syn_years=60,
+                           relative_accuracy=relative_accuracy)
+    init_plotting()
+    render_moments(path, sitename, scenario)